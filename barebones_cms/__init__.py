@@ -0,0 +1 @@
+default_app_config = 'barebones_cms.apps.BarebonesCMSConfig'
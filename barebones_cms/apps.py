@@ -0,0 +1,28 @@
+from django.apps import AppConfig, apps
+from django.conf import settings
+
+
+# Allow the cms app to be completely overridden with another namespace
+CMS_APP = getattr(settings, 'BB_CMS_APP_NAME', 'apps.cms').split('.')[-1]
+
+
+class BarebonesCMSConfig(AppConfig):
+    name = 'barebones_cms'
+    verbose_name = 'Barebones CMS'
+
+    def ready(self):
+        from barebones_cms.registry import content_block_registry
+
+        try:
+            cms_app_config = apps.get_app_config(CMS_APP)
+        except LookupError:
+            # The CMS app is not installed, blocks have to be registered
+            return
+        content_block_registry.register_app(cms_app_config)
+
+        from barebones_cms import signals
+        signals.connect_signals()
+
+        from barebones_cms import plans
+        if plans.RENDER_PLANS_ENABLED:
+            plans.connect_signals()
@@ -0,0 +1,19 @@
+from collections import OrderedDict
+
+
+# The most queries each scenario may run, as a fixed number plus a number
+# per block type, since blocks are loaded with one query per content type.
+# None of them may grow with the number of pages, regions or blocks.
+QUERY_BUDGETS = OrderedDict([
+    ('get_page_from_path', (1, 0)),
+    ('serve_page', (5, 1)),
+    ('dashboard_pages', (2, 0)),
+    ('dashboard_page_edit', (6, 1)),
+])
+
+
+def get_query_budgets(shape):
+    """ Returns the query budget of each scenario for a site shape """
+    block_types = len(shape.get_block_models())
+    return dict((name, fixed + per_block_type * block_types)
+                for name, (fixed, per_block_type) in QUERY_BUDGETS.iteritems())
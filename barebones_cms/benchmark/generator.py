@@ -0,0 +1,224 @@
+import hashlib
+import os
+import random
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.files.base import ContentFile
+from django.core.management.color import no_style
+from django.db import connection, models, transaction
+from django.db.models.loading import get_model
+
+from barebones_cms.loading import template_cache
+from barebones_cms.registry import content_block_registry
+from barebones_cms.routing import page_route_index
+from barebones_cms.services import PageService
+
+
+# Allow the cms app to be completely overridden with another namespace
+CMS_APP = getattr(settings, 'BB_CMS_APP_NAME', 'apps.cms').split('.')[-1]
+# Where the generated page templates and partials are saved in the storage
+# of the template file fields
+TEMPLATE_DIRECTORY = 'templates/cms/benchmark/'
+
+
+Page = get_model(CMS_APP, 'Page')
+PageTemplate = get_model(CMS_APP, 'PageTemplate')
+Region = get_model(CMS_APP, 'Region')
+ContentBlockLink = get_model(CMS_APP, 'ContentBlockLink')
+
+
+class SiteShape(object):
+    """ The size and shape of a generated site. Every page below the roots
+        has fanout children until the tree is depth levels deep.
+    """
+    def __init__(self, roots=1, depth=4, fanout=5, templates=1,
+                 regions_per_template=3, blocks_per_region=4, block_types=None):
+        self.roots = roots
+        self.depth = depth
+        self.fanout = fanout
+        self.templates = templates
+        self.regions_per_template = regions_per_template
+        self.blocks_per_region = blocks_per_region
+        # Labels such as 'barebones_cms.simplecontentblock'. Defaults to
+        # every registered block model.
+        self.block_types = block_types
+
+    def get_block_models(self):
+        if not self.block_types:
+            return content_block_registry.get_models()
+        return [ContentType.objects.get_by_natural_key(
+                    *label.lower().split('.')).model_class()
+                for label in self.block_types]
+
+    def as_dict(self):
+        return {
+            'roots': self.roots,
+            'depth': self.depth,
+            'fanout': self.fanout,
+            'templates': self.templates,
+            'regions_per_template': self.regions_per_template,
+            'blocks_per_region': self.blocks_per_region,
+            'block_types': ['%s.%s' % (model._meta.app_label, model._meta.model_name)
+                            for model in self.get_block_models()],
+        }
+
+
+class SiteGenerator(object):
+    """ Fills an empty database with a synthetic site.
+
+        Rows are created with bulk inserts and given their primary keys up
+        front, so the tree and paths are worked out once at the end rather
+        than as each page is added. The same shape and seed always give the
+        same site.
+
+        Page templates and partials are saved to directory in the storage of
+        the template file fields, named after their content. Files already
+        there are reused and never overwritten.
+    """
+    def __init__(self, shape, seed=0, directory=TEMPLATE_DIRECTORY):
+        self.shape = shape
+        self.random = random.Random(seed)
+        self.directory = directory
+
+    @transaction.atomic
+    def generate(self):
+        """ Creates the site and returns the number of each kind of object """
+        regions_by_template = self.create_templates()
+        page_templates = list(regions_by_template)
+        pages = self.create_pages(page_templates)
+        block_count, link_count = self.create_blocks(pages, regions_by_template)
+
+        service = PageService()
+        service.rebuild_page_tree()
+        service.rebuild_page_paths()
+        template_cache.clear()
+        page_route_index.invalidate()
+        return {'templates': len(page_templates),
+                'pages': len(pages),
+                'blocks': block_count,
+                'links': link_count}
+
+    def create_templates(self):
+        regions_by_template = OrderedDict()
+        for template_index in range(1, self.shape.templates + 1):
+            block_names = ['region_%s' % index for index in
+                           range(1, self.shape.regions_per_template + 1)]
+            template_file = self.save_file(
+                'page_%s.html' % template_index, self.get_page_source(block_names))
+            page_template = PageTemplate.objects.create(
+                name='Benchmark template %s' % template_index,
+                template_file=template_file)
+            regions_by_template[page_template] = [
+                Region.objects.create(name=block_name, block_name=block_name,
+                                      template=page_template)
+                for block_name in block_names]
+        return regions_by_template
+
+    def get_page_source(self, block_names):
+        source = ['<html><head><title>{{ page.title }}</title></head><body>']
+        for block_name in block_names:
+            source.append('<div>{%% for block in %s.content_blocks %%}'
+                          '{{ block }}{%% endfor %%}</div>' % block_name)
+        source.append('</body></html>')
+        return '\n'.join(source)
+
+    def save_file(self, name, source):
+        """ Saves a generated file and returns its name in storage. Raises
+            GeneratedFileConflictException if a different file already has
+            that name.
+        """
+        storage = PageTemplate._meta.get_field('template_file').storage
+        base, extension = os.path.splitext(name)
+        name = '%s%s-%s%s' % (self.directory, base,
+                              hashlib.md5(source).hexdigest()[:12], extension)
+        if not storage.exists(name):
+            return storage.save(name, ContentFile(source))
+
+        existing_file = storage.open(name)
+        try:
+            if existing_file.read() != source:
+                raise GeneratedFileConflictException(name)
+        finally:
+            existing_file.close()
+        return name
+
+    def create_pages(self, page_templates):
+        pk = self.get_first_pk(Page)
+        pages = []
+        parents = [None] * self.shape.roots
+        for level in range(self.shape.depth):
+            children = []
+            for parent in parents:
+                for index in range(1 if parent is None else self.shape.fanout):
+                    page = Page(
+                        pk=pk, parent=parent,
+                        title='Page %s' % pk, slug='page-%s' % pk,
+                        page_template=self.random.choice(page_templates),
+                        is_published=True,
+                        # Filled in by the tree rebuild
+                        tree_id=0, lft=0, rght=0, level=level)
+                    pk += 1
+                    children.append(page)
+            pages.extend(children)
+            parents = children
+        Page.objects.bulk_create(pages, batch_size=500)
+        self.reset_sequence(Page)
+        return pages
+
+    def create_blocks(self, pages, regions_by_template):
+        block_models = self.shape.get_block_models()
+        partials = dict(
+            (model, self.save_file(
+                '%s.html' % model._meta.model_name,
+                '<p>{{ content_block.name }}</p>'))
+            for model in block_models)
+        next_pks = dict((model, self.get_first_pk(model)) for model in block_models)
+        blocks = dict((model, []) for model in block_models)
+        links = []
+        for page in pages:
+            for region in regions_by_template[page.page_template]:
+                for position in range(self.shape.blocks_per_region):
+                    model = self.random.choice(block_models)
+                    pk = next_pks[model]
+                    next_pks[model] += 1
+                    blocks[model].append(model(
+                        pk=pk, partial=partials[model],
+                        **self.get_block_fields(model, pk)))
+                    links.append(ContentBlockLink(
+                        page=page, region=region, object_id=pk,
+                        content_type=ContentType.objects.get_for_model(model),
+                        position=position))
+
+        for model, model_blocks in blocks.iteritems():
+            model.objects.bulk_create(model_blocks, batch_size=500)
+            self.reset_sequence(model)
+        ContentBlockLink.objects.bulk_create(links, batch_size=500)
+        self.reset_sequence(ContentBlockLink)
+        return sum(len(model_blocks) for model_blocks in blocks.values()), len(links)
+
+    def get_block_fields(self, model, pk):
+        """ Fills in the name and any other required text field of a block """
+        fields = {'name': 'Block %s' % pk}
+        for field in model._meta.concrete_fields:
+            if (field.name in fields or field.name == 'partial' or
+                    field.primary_key or field.null or field.has_default()):
+                continue
+            if isinstance(field, (models.CharField, models.TextField)):
+                text = 'Content of block %s' % pk
+                fields[field.name] = text[:field.max_length] if field.max_length else text
+        return fields
+
+    def get_first_pk(self, model):
+        last_pk = model.objects.aggregate(last_pk=models.Max('pk'))['last_pk']
+        return (last_pk or 0) + 1
+
+    def reset_sequence(self, model):
+        cursor = connection.cursor()
+        for sql in connection.ops.sequence_reset_sql(no_style(), [model]):
+            cursor.execute(sql)
+
+
+class GeneratedFileConflictException(Exception):
+    pass
@@ -0,0 +1,188 @@
+import json
+import platform
+import random
+import resource
+import time
+from collections import OrderedDict
+
+import django
+from django.db import connection, reset_queries
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from barebones_cms.benchmark.generator import Page
+from barebones_cms.services import PageService, URLService
+from barebones_cms.testing import QueryBudgetExceeded, assert_max_queries
+
+
+# Bumped whenever the layout of the results changes
+RESULTS_FORMAT = 1
+PERCENTILES = (50, 90, 99)
+# Latencies below this are too noisy to flag as regressions, in milliseconds
+MIN_REGRESSION_MS = 1.0
+
+
+class BenchmarkRunner(object):
+    """ Times the CMS against whatever site is in the database.
+
+        Each scenario is called a few times to warm up and then timed over a
+        number of iterations, picking pages with a seeded random generator
+        so runs against the same site are comparable. Queries are counted
+        per iteration and the peak memory of the process is taken after each
+        scenario.
+
+        Scenarios with a query budget are checked on every iteration. The
+        first iteration of each to go over is kept in budget_failures.
+    """
+    def __init__(self, iterations=200, warmup=10, seed=0, budgets=None):
+        self.iterations = iterations
+        self.warmup = warmup
+        self.seed = seed
+        self.budgets = budgets or {}
+        self.budget_failures = OrderedDict()
+        self.client = Client()
+
+    def get_scenarios(self):
+        return OrderedDict([
+            ('get_page_from_path', self.get_page_from_path),
+            ('serve_page', self.serve_page),
+            ('dashboard_pages', self.dashboard_pages),
+            ('dashboard_page_edit', self.dashboard_page_edit),
+        ])
+
+    def run(self, scenario_names=None):
+        scenarios = self.get_scenarios()
+        self.paths = list(Page.objects.exclude(path=None).order_by(
+            'pk').values_list('path', flat=True))
+        self.page_pks = list(Page.objects.order_by('pk').values_list('pk', flat=True))
+
+        results = OrderedDict()
+        for name in scenario_names or scenarios:
+            self.random = random.Random(self.seed)
+            results[name] = self.measure(name, scenarios[name])
+        return results
+
+    def measure(self, name, scenario):
+        for iteration in range(self.warmup):
+            scenario()
+
+        latencies = []
+        query_counts = []
+        errors = 0
+        budget = self.budgets.get(name)
+        for iteration in range(self.iterations):
+            if budget is None:
+                queries = CaptureQueriesContext(connection)
+            else:
+                queries = assert_max_queries(budget, label=name)
+            try:
+                with queries:
+                    started = time.time()
+                    ok = scenario()
+                    latencies.append((time.time() - started) * 1000)
+            except QueryBudgetExceeded as e:
+                self.budget_failures.setdefault(name, str(e))
+            query_counts.append(len(queries))
+            # Don't let the query log grow for the whole run
+            reset_queries()
+            if not ok:
+                errors += 1
+
+        result = OrderedDict()
+        result['iterations'] = self.iterations
+        result['errors'] = errors
+        latencies.sort()
+        for percentile in PERCENTILES:
+            result['p%s_ms' % percentile] = round(
+                self.get_percentile(latencies, percentile), 3)
+        result['max_ms'] = round(latencies[-1], 3)
+        result['mean_ms'] = round(sum(latencies) / len(latencies), 3)
+        result['queries_mean'] = round(float(sum(query_counts)) / len(query_counts), 2)
+        result['queries_max'] = max(query_counts)
+        if budget is not None:
+            result['queries_budget'] = budget
+        result['peak_memory_kb'] = self.get_peak_memory()
+        return result
+
+    def get_percentile(self, values, percentile):
+        """ The nearest rank percentile of sorted values """
+        index = int(round((len(values) - 1) * percentile / 100.0))
+        return values[index]
+
+    def get_peak_memory(self):
+        # Reported in kilobytes on Linux and bytes on OS X
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if platform.system() == 'Darwin':
+            peak //= 1024
+        return peak
+
+    def get_page_from_path(self):
+        path = self.random.choice(self.paths)
+        return PageService().get_page_from_path('/%s/' % path) is not None
+
+    def serve_page(self):
+        path = self.random.choice(self.paths)
+        response = self.client.get('/%s/' % path)
+        if response.streaming:
+            b''.join(response.streaming_content)
+        return response.status_code == 200
+
+    def dashboard_pages(self):
+        response = self.client.get(URLService().get_page_index_url())
+        return response.status_code == 200
+
+    def dashboard_page_edit(self):
+        pk = self.random.choice(self.page_pks)
+        response = self.client.get(URLService().get_page_edit_url(pk))
+        return response.status_code == 200
+
+
+def build_results(shape, site, scenarios):
+    return OrderedDict([
+        ('format', RESULTS_FORMAT),
+        ('created', timezone.now().isoformat()),
+        ('environment', OrderedDict([
+            ('python', platform.python_version()),
+            ('django', django.get_version()),
+            ('database', connection.vendor),
+        ])),
+        ('shape', shape.as_dict()),
+        ('site', site),
+        ('scenarios', scenarios),
+    ])
+
+
+def load_results(path):
+    with open(path) as results_file:
+        return json.load(results_file)
+
+
+def save_results(path, results):
+    with open(path, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+        results_file.write('\n')
+
+
+def find_regressions(results, baseline, threshold=0.2):
+    """ Compares results against a baseline run and returns a message for
+        every scenario that has slowed down by more than the threshold or
+        runs more queries than it did
+    """
+    regressions = []
+    if results['shape'] != baseline['shape']:
+        regressions.append("The baseline was run against a different site shape")
+    for name, result in results['scenarios'].iteritems():
+        base = baseline['scenarios'].get(name)
+        if base is None:
+            continue
+        for percentile in PERCENTILES:
+            key = 'p%s_ms' % percentile
+            limit = max(base[key] * (1 + threshold), base[key] + MIN_REGRESSION_MS)
+            if result[key] > limit:
+                regressions.append("%s %s went from %.2fms to %.2fms" % (
+                    name, key, base[key], result[key]))
+        if result['queries_max'] > base['queries_max']:
+            regressions.append("%s runs up to %s queries, up from %s" % (
+                name, result['queries_max'], base['queries_max']))
+    return regressions
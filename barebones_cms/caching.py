@@ -0,0 +1,243 @@
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
+from django.http import HttpResponse
+
+from barebones_cms.routing import normalise_path
+
+
+# Cache rendered CMS pages. Off by default as cached pages are shared between
+# all visitors, so page templates must not depend on the request.
+PAGE_CACHE_ENABLED = getattr(settings, 'BB_CMS_PAGE_CACHE', False)
+# The cache backend (from CACHES) used by the CMS
+CACHE_ALIAS = getattr(settings, 'BB_CMS_CACHE', 'default')
+# How long a rendered page is considered fresh, in seconds
+PAGE_CACHE_TIMEOUT = getattr(settings, 'BB_CMS_PAGE_CACHE_TIMEOUT', 300)
+# How long a page may still be served after it has gone stale while a single
+# request renders a fresh copy, in seconds
+PAGE_CACHE_STALE_TIMEOUT = getattr(settings, 'BB_CMS_PAGE_CACHE_STALE_TIMEOUT', 0)
+# Cache the rendered partial of each content block. Fragments are shared by
+# every page showing the block, so partials should only use the block itself.
+FRAGMENT_CACHE_ENABLED = getattr(settings, 'BB_CMS_FRAGMENT_CACHE', False)
+FRAGMENT_CACHE_TIMEOUT = getattr(settings, 'BB_CMS_FRAGMENT_CACHE_TIMEOUT', 3600)
+# Count the requests for each page so cms_warm_cache can warm the most popular
+# pages first. Costs a cache increment per request.
+RECORD_PAGE_HITS = getattr(settings, 'BB_CMS_RECORD_PAGE_HITS', False)
+# How long a page's count is kept from its first hit, in seconds
+PAGE_HITS_TIMEOUT = getattr(settings, 'BB_CMS_PAGE_HITS_TIMEOUT', 7 * 24 * 60 * 60)
+
+# Response headers kept with a cached page
+CACHED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+PAGE_KEY_PREFIX = 'bb_cms:page:'
+FRAGMENT_KEY_PREFIX = 'bb_cms:fragment:'
+REFRESH_KEY_PREFIX = 'bb_cms:page_refresh:'
+PAGE_HITS_KEY_PREFIX = 'bb_cms:page_hits:'
+# Rendering a page should never take this long. If it does the lock expires
+# and another request gets to try.
+REFRESH_LOCK_TIMEOUT = 30
+INVALIDATION_BATCH_SIZE = 500
+
+
+def get_cms_cache():
+    return caches[CACHE_ALIAS]
+
+
+class CacheStats(object):
+    """ Thread safe in-process counters for page cache lookups """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.stale_hits = 0
+            self.misses = 0
+
+    def record(self, outcome):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def as_dict(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'stale_hits': self.stale_hits,
+                    'misses': self.misses}
+
+
+class PageCache(object):
+    """ Caches fully rendered pages by path.
+
+        Entries are kept for the fresh timeout plus the stale timeout. Once
+        an entry goes stale the first request to see it renders the page
+        again while everyone else keeps getting the stale copy.
+    """
+    def __init__(self):
+        self.stats = CacheStats()
+
+    def is_enabled(self):
+        return PAGE_CACHE_ENABLED
+
+    def is_cacheable_request(self, request):
+        return self.is_enabled() and request.method in ('GET', 'HEAD')
+
+    def is_cacheable_response(self, response):
+        return response.status_code == 200
+
+    def get_key(self, path):
+        path = normalise_path(path).encode('utf-8')
+        return PAGE_KEY_PREFIX + hashlib.md5(path).hexdigest()
+
+    def get_response(self, path):
+        """ Returns the cached response for a path, or None if the page has
+            to be rendered.
+        """
+        cache = get_cms_cache()
+        key = self.get_key(path)
+        entry = cache.get(key)
+        if entry is None:
+            self.stats.record('misses')
+            return None
+
+        if entry['fresh_until'] < time.time():
+            # Only one request gets to refresh the page
+            if cache.add(REFRESH_KEY_PREFIX + key, 1, REFRESH_LOCK_TIMEOUT):
+                self.stats.record('misses')
+                return None
+            self.stats.record('stale_hits')
+            return self.build_response(entry, 'STALE')
+
+        self.stats.record('hits')
+        return self.build_response(entry, 'HIT')
+
+    def build_response(self, entry, status):
+        response = HttpResponse(entry['content'])
+        for header, value in entry['headers'].iteritems():
+            response[header] = value
+        response['X-CMS-Cache'] = status
+        return response
+
+    def set_response(self, path, response):
+        headers = dict((header, response[header])
+                       for header in CACHED_HEADERS if response.has_header(header))
+        response['X-CMS-Cache'] = 'MISS'
+        if response.streaming:
+            # Store the page once the last chunk has been sent
+            response.streaming_content = self.iter_and_store(
+                path, response.streaming_content, headers)
+        else:
+            self.store(path, response.content, headers)
+
+    def iter_and_store(self, path, streaming_content, headers):
+        chunks = []
+        for chunk in streaming_content:
+            chunks.append(chunk)
+            yield chunk
+        self.store(path, b''.join(chunks), headers)
+
+    def store(self, path, content, headers):
+        cache = get_cms_cache()
+        key = self.get_key(path)
+        entry = {'content': content,
+                 'headers': headers,
+                 'fresh_until': time.time() + PAGE_CACHE_TIMEOUT}
+        cache.set(key, entry, PAGE_CACHE_TIMEOUT + PAGE_CACHE_STALE_TIMEOUT)
+        cache.delete(REFRESH_KEY_PREFIX + key)
+
+    def invalidate_paths(self, paths):
+        if not self.is_enabled():
+            return
+        cache = get_cms_cache()
+        keys = [self.get_key(path) for path in paths if path is not None]
+        for start in range(0, len(keys), INVALIDATION_BATCH_SIZE):
+            cache.delete_many(keys[start:start + INVALIDATION_BATCH_SIZE])
+
+    def invalidate_pages(self, pages):
+        """ Removes the cached copy of every servable page in a queryset """
+        if not self.is_enabled():
+            return
+        paths = pages.exclude(path=None).values_list('path', flat=True)
+        self.invalidate_paths(paths.iterator())
+
+    def get_stats(self):
+        return self.stats.as_dict()
+
+
+class FragmentCache(object):
+    """ Caches the rendered partial of each content block.
+
+        Keys include the version of the block, which is bumped whenever the
+        block is saved, so old fragments are never read and simply expire.
+        A page reads and writes all of its fragments in one go.
+    """
+    def is_enabled(self):
+        return FRAGMENT_CACHE_ENABLED
+
+    def get_key(self, block):
+        content_type = ContentType.objects.get_for_model(block)
+        return '%s%s:%s:%s' % (
+            FRAGMENT_KEY_PREFIX, content_type.pk, block.pk, block.version)
+
+    def get_many(self, blocks):
+        """ Returns the cached fragments of a list of blocks as a dict keyed
+            by fragment key. Blocks missing from the dict need rendering.
+        """
+        if not self.is_enabled() or not blocks:
+            return {}
+        keys = [self.get_key(block) for block in blocks]
+        return get_cms_cache().get_many(keys)
+
+    def set_many(self, fragments):
+        if not self.is_enabled() or not fragments:
+            return
+        get_cms_cache().set_many(fragments, FRAGMENT_CACHE_TIMEOUT)
+
+
+class PageHitCounter(object):
+    """ Counts the requests for each path in the CMS cache.
+
+        Counts start with the first hit and expire with it, so they cover
+        roughly the last PAGE_HITS_TIMEOUT seconds. They are only used to
+        order pages and a lost increment does not matter.
+    """
+    def is_enabled(self):
+        return RECORD_PAGE_HITS
+
+    def get_key(self, path):
+        path = normalise_path(path).encode('utf-8')
+        return PAGE_HITS_KEY_PREFIX + hashlib.md5(path).hexdigest()
+
+    def record(self, path):
+        if not self.is_enabled():
+            return
+        cache = get_cms_cache()
+        key = self.get_key(path)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # The first hit, or the count has expired
+            cache.add(key, 1, PAGE_HITS_TIMEOUT)
+
+    def get_counts(self, paths):
+        """ Returns the hit count of each path as a dict. Paths without a
+            count are left out.
+        """
+        cache = get_cms_cache()
+        counts = {}
+        paths = list(paths)
+        for start in range(0, len(paths), INVALIDATION_BATCH_SIZE):
+            keys = dict((self.get_key(path), path)
+                        for path in paths[start:start + INVALIDATION_BATCH_SIZE])
+            for key, count in cache.get_many(keys.keys()).iteritems():
+                counts[keys[key]] = count
+        return counts
+
+
+page_cache = PageCache()
+fragment_cache = FragmentCache()
+page_hits = PageHitCounter()
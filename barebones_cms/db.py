@@ -0,0 +1,37 @@
+from django.db import connection
+
+
+def bulk_update_field(model, field_name, values_by_pk, batch_size=500):
+    """ Sets a field to a different value on many rows using a single
+        UPDATE ... CASE statement per batch instead of one query per row.
+    """
+    rows_by_pk = dict((pk, (value,)) for pk, value in values_by_pk.items())
+    bulk_update_fields(model, [field_name], rows_by_pk, batch_size)
+
+
+def bulk_update_fields(model, field_names, rows_by_pk, batch_size=500):
+    """ The same as bulk_update_field for several fields at once. Each row is
+        a tuple of values in the same order as field_names.
+    """
+    fields = [model._meta.get_field(field_name) for field_name in field_names]
+    quote_name = connection.ops.quote_name
+    table = quote_name(model._meta.db_table)
+    pk_column = quote_name(model._meta.pk.column)
+
+    items = list(rows_by_pk.items())
+    cursor = connection.cursor()
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        assignments = []
+        params = []
+        for index, field in enumerate(fields):
+            assignments.append('%s = CASE %s %s END' % (
+                quote_name(field.column), pk_column,
+                ' '.join(['WHEN %s THEN %s'] * len(batch))))
+            for pk, row in batch:
+                params.extend([pk, field.get_db_prep_save(row[index], connection)])
+        params.extend([pk for pk, row in batch])
+        sql = 'UPDATE %s SET %s WHERE %s IN (%s)' % (
+            table, ', '.join(assignments),
+            pk_column, ', '.join(['%s'] * len(batch)))
+        cursor.execute(sql, params)
@@ -1,15 +1,48 @@
 from django import forms
-from django.forms.models import modelform_factory
+from django.forms.models import ModelChoiceIterator
 
+from barebones_cms.registry import content_block_registry
 from barebones_cms.services import PageService
 
 
+class PageChoiceIterator(ModelChoiceIterator):
+    """ Lists pages in tree order, labelled with their ancestors' slugs as
+        Page.__unicode__ does, but built from the labels of the parents
+        already listed rather than loading every parent again
+    """
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ("", self.field.empty_label)
+        labels = {}
+        for page in self.queryset.order_by('tree_id', 'lft'):
+            if page.parent_id is None:
+                label = page.slug
+            elif page.parent_id in labels:
+                label = "%s > %s" % (labels[page.parent_id], page.slug)
+            else:
+                # The parent is not one of the choices
+                label = self.field.label_from_instance(page)
+            labels[page.pk] = label
+            yield (self.field.prepare_value(page), label)
+
+
+class PageChoiceField(forms.ModelChoiceField):
+    def _get_choices(self):
+        if hasattr(self, '_choices'):
+            return self._choices
+        return PageChoiceIterator(self)
+
+    choices = property(_get_choices, forms.ChoiceField._set_choices)
+
+
 class PageForm(forms.Form):
     title = forms.CharField(max_length=255)
     slug = forms.SlugField(max_length=100)
     page_template = forms.ModelChoiceField(queryset=None)
-    parent = forms.ModelChoiceField(queryset=None, required=False)
+    parent = PageChoiceField(queryset=None, required=False)
     is_published = forms.BooleanField(required=False)
+    publish_at = forms.DateTimeField(required=False)
+    unpublish_at = forms.DateTimeField(required=False)
 
     def __init__(self, *args, **kwargs):
         super(PageForm, self).__init__(*args, **kwargs)
@@ -26,6 +59,7 @@ class PageForm(forms.Form):
 class PageTemplateForm(forms.Form):
     name = forms.CharField(max_length=200)
     template_file = forms.FileField(max_length=255)
+    stream_response = forms.BooleanField(required=False)
 
 
 class RegionForm(forms.Form):
@@ -43,5 +77,4 @@ class RegionForm(forms.Form):
 
 # This is used for creating model forms from the content blocks
 def get_modelform(model):
-    modelform_class = modelform_factory(model)
-    return modelform_class
+    return content_block_registry.get_form_class(model)
@@ -0,0 +1,186 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from django.conf import settings
+from django.db import connection
+
+
+# Count the queries run in each stage. Off by default as it needs the debug
+# cursor, which keeps a copy of every query for the length of each request.
+INSTRUMENT_QUERIES = getattr(settings, 'BB_CMS_INSTRUMENT_QUERIES', False)
+# Upper bounds of the histogram buckets, in seconds
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_local = threading.local()
+
+
+class RequestTimings(object):
+    """ The time taken and queries run by each stage of a request. Stages
+        run more than once, such as rendering each block, are added up.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.stages = OrderedDict()
+        self.annotations = {}
+
+    def add(self, name, duration, queries):
+        total_duration, total_queries, count = self.stages.get(name, (0, 0, 0))
+        self.stages[name] = (total_duration + duration,
+                             total_queries + queries, count + 1)
+
+    def get_duration(self):
+        return time.time() - self.started
+
+
+def start_request():
+    _local.timings = RequestTimings()
+    return _local.timings
+
+
+def get_timings():
+    return getattr(_local, 'timings', None)
+
+
+def set_timings(timings):
+    _local.timings = timings
+
+
+def annotate(**annotations):
+    """ Attaches details such as the page being served to the current
+        request's timings
+    """
+    timings = get_timings()
+    if timings is not None:
+        timings.annotations.update(annotations)
+
+
+def count_queries():
+    return len(connection.queries) if INSTRUMENT_QUERIES else 0
+
+
+class stage(object):
+    """ Times a stage of the current request, either as a context manager or
+        as a method decorator. Does nothing unless the instrumentation
+        middleware is installed.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, func):
+        @wraps(func)
+        def timed(*args, **kwargs):
+            with stage(self.name):
+                return func(*args, **kwargs)
+        return timed
+
+    def __enter__(self):
+        self.timings = get_timings()
+        if self.timings is not None:
+            self.started = time.time()
+            self.queries = count_queries()
+
+    def __exit__(self, *exc_info):
+        if self.timings is not None:
+            self.timings.add(self.name, time.time() - self.started,
+                             count_queries() - self.queries)
+
+
+class Histogram(object):
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+class MetricsRegistry(object):
+    """ Thread safe in-process counters and histograms, keyed by metric name
+        and a tuple of label pairs. Each process keeps its own.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.help = {}
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def increment(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        key = (name, tuple(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def render(self, extra_counters=()):
+        """ Returns every metric in the Prometheus text format. Extra
+            counters are (name, labels, value) tuples kept elsewhere.
+        """
+        with self._lock:
+            counters = sorted(self.counters.items()) + [
+                ((name, tuple(labels)), value)
+                for name, labels, value in extra_counters]
+            histograms = sorted(
+                (key, (histogram.buckets, list(histogram.counts),
+                       histogram.count, histogram.sum))
+                for key, histogram in self.histograms.items())
+
+        lines = []
+        described = set()
+        for (name, labels), value in counters:
+            self.render_header(lines, described, name, 'counter')
+            lines.append('%s%s %s' % (name, self.format_labels(labels), value))
+        for (name, labels), (buckets, counts, count, total) in histograms:
+            self.render_header(lines, described, name, 'histogram')
+            for bound, bucket_count in zip(buckets, counts):
+                lines.append('%s_bucket%s %s' % (
+                    name, self.format_labels(labels + (('le', bound),)),
+                    bucket_count))
+            lines.append('%s_bucket%s %s' % (
+                name, self.format_labels(labels + (('le', '+Inf'),)), count))
+            lines.append('%s_sum%s %s' % (name, self.format_labels(labels), total))
+            lines.append('%s_count%s %s' % (name, self.format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def render_header(self, lines, described, name, metric_type):
+        if name in described:
+            return
+        described.add(name)
+        if name in self.help:
+            lines.append('# HELP %s %s' % (name, self.help[name]))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+
+    def format_labels(self, labels):
+        if not labels:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (name, unicode(value).replace('\\', '\\\\').replace('"', '\\"'))
+            for name, value in labels)
+
+
+metrics = MetricsRegistry()
+metrics.describe('bb_cms_requests_total', 'CMS pages served by status code.')
+metrics.describe('bb_cms_request_duration_seconds', 'Time taken to serve CMS pages.')
+metrics.describe('bb_cms_stage_duration_seconds', 'Time taken by each stage of serving a page.')
+metrics.describe('bb_cms_stage_queries_total', 'SQL queries run by each stage of serving a page.')
+metrics.describe('bb_cms_page_cache_total', 'Page cache lookups by outcome.')
@@ -0,0 +1,68 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.template import loader
+
+
+# The number of compiled page templates and partials kept in memory
+TEMPLATE_CACHE_SIZE = getattr(settings, 'BB_CMS_TEMPLATE_CACHE_SIZE', 128)
+
+
+class TemplateCache(object):
+    """ A bounded LRU cache of compiled page templates and block partials.
+
+        Templates are loaded through the storage of the file field they were
+        uploaded to and are keyed by their name. The modification time
+        reported by the storage is checked on every lookup so a file changed
+        in place is compiled again.
+    """
+    def __init__(self, max_size=TEMPLATE_CACHE_SIZE):
+        self.max_size = max_size
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_template(self, field_file):
+        name = field_file.name
+        version = self.get_file_version(field_file)
+        with self._lock:
+            cached = self._templates.pop(name, None)
+            if cached is not None and cached[0] == version:
+                # Move it to the most recently used end
+                self._templates[name] = cached
+                return cached[1]
+
+        template = self.compile_template(field_file)
+        with self._lock:
+            self._templates[name] = (version, template)
+            while len(self._templates) > self.max_size:
+                self._templates.popitem(last=False)
+        return template
+
+    def get_file_version(self, field_file):
+        try:
+            return field_file.storage.modified_time(field_file.name)
+        except (NotImplementedError, EnvironmentError):
+            # Not every storage can tell us. Rely on invalidation instead.
+            return None
+
+    def compile_template(self, field_file):
+        template_file = field_file.storage.open(field_file.name)
+        try:
+            source = template_file.read().decode(settings.FILE_CHARSET)
+        finally:
+            template_file.close()
+        return loader.get_template_from_string(source, name=field_file.name)
+
+    def invalidate(self, *names):
+        with self._lock:
+            for name in names:
+                if name:
+                    self._templates.pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+
+
+template_cache = TemplateCache()
@@ -0,0 +1,15 @@
+from django.core.management.base import NoArgsCommand
+
+from barebones_cms.services import PageService
+
+
+class Command(NoArgsCommand):
+    help = "Calculates the stored path of every CMS page."
+
+    def handle_noargs(self, **options):
+        conflicts = PageService().rebuild_page_paths()
+        for path in conflicts:
+            self.stderr.write(
+                "More than one published page uses the path '%s'. It will "
+                "not be served until the conflict is fixed." % path)
+        self.stdout.write("Page paths rebuilt.")
@@ -0,0 +1,102 @@
+import json
+import shutil
+import tempfile
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from barebones_cms.benchmark.budgets import get_query_budgets
+from barebones_cms.benchmark.generator import SiteGenerator, SiteShape
+from barebones_cms.benchmark.runner import (
+    BenchmarkRunner, build_results, find_regressions, load_results,
+    save_results)
+
+
+class Command(BaseCommand):
+    help = ("Generates a synthetic site in a test database and benchmarks "
+            "serving and editing it. Results are printed as JSON and can be "
+            "saved and compared against a baseline run.")
+    option_list = BaseCommand.option_list + (
+        make_option('--roots', type='int', default=1,
+                    help="Number of top level pages."),
+        make_option('--depth', type='int', default=4,
+                    help="Number of levels in each page tree."),
+        make_option('--fanout', type='int', default=5,
+                    help="Number of children of each page above the last level."),
+        make_option('--templates', type='int', default=1,
+                    help="Number of page templates."),
+        make_option('--regions', type='int', default=3,
+                    help="Number of regions in each page template."),
+        make_option('--blocks', type='int', default=4,
+                    help="Number of blocks in each region of a page."),
+        make_option('--block-type', action='append', dest='block_types',
+                    help="A block model to use, such as "
+                         "barebones_cms.simplecontentblock. Can be repeated. "
+                         "Defaults to every registered block model."),
+        make_option('--scenario', action='append', dest='scenarios',
+                    help="Only run this scenario. Can be repeated."),
+        make_option('--iterations', type='int', default=200,
+                    help="Number of timed runs of each scenario."),
+        make_option('--warmup', type='int', default=10,
+                    help="Number of untimed runs before timing each scenario."),
+        make_option('--seed', type='int', default=0,
+                    help="Seed for generating the site and picking pages."),
+        make_option('--check-budgets', action='store_true', default=False,
+                    help="Fail if any scenario runs more queries than its "
+                         "budget, listing the queries by where they were run."),
+        make_option('--output', help="Save the results to this file."),
+        make_option('--baseline',
+                    help="Compare the results with those saved in this file "
+                         "and fail if any scenario has regressed."),
+        make_option('--threshold', type='float', default=0.2,
+                    help="How much slower than the baseline a scenario may "
+                         "be before it counts as a regression (default 0.2)."),
+    )
+
+    def handle(self, *args, **options):
+        shape = SiteShape(
+            roots=options['roots'], depth=options['depth'],
+            fanout=options['fanout'], templates=options['templates'],
+            regions_per_template=options['regions'],
+            blocks_per_region=options['blocks'],
+            block_types=options['block_types'])
+        runner = BenchmarkRunner(iterations=options['iterations'],
+                                 warmup=options['warmup'], seed=options['seed'])
+        scenarios = options['scenarios']
+        unknown = set(scenarios or []) - set(runner.get_scenarios())
+        if unknown:
+            raise CommandError("Unknown scenarios: %s" % ', '.join(sorted(unknown)))
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False)
+        # Content types were created again with the test database
+        ContentType.objects.clear_cache()
+        # The generated templates are thrown away with the database
+        media_root = tempfile.mkdtemp(prefix='bb_cms_benchmark_')
+        try:
+            with override_settings(ALLOWED_HOSTS=['*'], MEDIA_ROOT=media_root):
+                site = SiteGenerator(shape, seed=options['seed']).generate()
+                if options['check_budgets']:
+                    runner.budgets = get_query_budgets(shape)
+                results = build_results(shape, site, runner.run(scenarios))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(media_root, ignore_errors=True)
+
+        self.stdout.write(json.dumps(results, indent=2))
+        if options['output']:
+            save_results(options['output'], results)
+        if runner.budget_failures:
+            raise CommandError("Query budgets exceeded:\n%s" % '\n'.join(
+                runner.budget_failures.values()))
+        if options['baseline']:
+            regressions = find_regressions(
+                results, load_results(options['baseline']), options['threshold'])
+            if regressions:
+                raise CommandError(
+                    "Regressions against the baseline:\n%s" % '\n'.join(regressions))
+            self.stdout.write("No regressions against the baseline.")
@@ -0,0 +1,22 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from barebones_cms.transfer import SiteTransferService
+
+
+class Command(BaseCommand):
+    args = "<file>"
+    help = ("Exports the CMS page templates, regions, pages, content blocks "
+            "and links as JSON Lines. Use - to write to stdout.")
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the file to export to, or - for stdout.")
+
+        if args[0] == '-':
+            count = SiteTransferService().export_site(sys.stdout)
+        else:
+            with open(args[0], 'w') as stream:
+                count = SiteTransferService().export_site(stream)
+            self.stdout.write("Exported %s objects." % count)
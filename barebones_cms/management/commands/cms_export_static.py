@@ -0,0 +1,32 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from barebones_cms.static_export import StaticSiteExporter
+
+
+class Command(BaseCommand):
+    args = "<directory>"
+    help = ("Renders every published page to <directory>/<path>/index.html "
+            "so the site can be served without Django.")
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', default=None,
+                    help="Number of processes to render with. Defaults to "
+                         "the number of CPUs."),
+        make_option('--incremental', action='store_true', default=False,
+                    help="Only render pages that changed since the last export."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the directory to export to.")
+
+        started = time.time()
+        exporter = StaticSiteExporter(args[0], workers=options['workers'],
+                                      incremental=options['incremental'])
+        counts = exporter.export()
+        self.stdout.write(
+            "Rendered %(rendered)s pages, skipped %(unchanged)s unchanged, "
+            "%(missing)s could not be served and %(removed)s were removed." % counts)
+        self.stdout.write("Took %.1fs." % (time.time() - started))
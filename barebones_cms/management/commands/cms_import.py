@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from barebones_cms.transfer import SiteTransferService
+
+
+class Command(BaseCommand):
+    args = "<file>"
+    help = ("Imports a file written by cms_export into an empty CMS. Template "
+            "and partial files have to be copied to the media root separately.")
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the file to import.")
+
+        with open(args[0]) as stream:
+            count, conflicts = SiteTransferService().import_site(stream)
+        for path in conflicts:
+            self.stderr.write(
+                "More than one published page uses the path '%s'. It will "
+                "not be served until the conflict is fixed." % path)
+        self.stdout.write("Imported %s objects." % count)
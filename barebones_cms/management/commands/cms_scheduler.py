@@ -0,0 +1,51 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from barebones_cms.services import PageService
+
+
+class Command(BaseCommand):
+    help = ("Publishes and unpublishes pages as their scheduled times pass. "
+            "Runs until stopped, sleeping until the next scheduled time.")
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help="Apply the transitions that are due and exit. "
+                         "Use this when running from cron."),
+        make_option('--max-sleep', type='int', dest='max_sleep', default=60,
+                    help="The longest time to sleep for, in seconds. Pages "
+                         "scheduled while the worker sleeps are picked up "
+                         "within this time."),
+    )
+
+    def handle(self, *args, **options):
+        service = PageService()
+        while True:
+            published, unpublished, conflicts = \
+                service.apply_scheduled_transitions()
+            self.report(published, unpublished, conflicts)
+            if options['once']:
+                return
+
+            next_due = service.get_next_scheduled_transition()
+            # Don't hold on to a connection while sleeping
+            connection.close()
+            time.sleep(self.get_sleep_time(next_due, options['max_sleep']))
+
+    def get_sleep_time(self, next_due, max_sleep):
+        if next_due is None:
+            return max_sleep
+        seconds = (next_due - timezone.now()).total_seconds()
+        return min(max(seconds, 0), max_sleep)
+
+    def report(self, published, unpublished, conflicts):
+        for pk in conflicts:
+            self.stderr.write(
+                "Page %s was not published as a published page next to it "
+                "already uses its slug." % pk)
+        if published or unpublished:
+            self.stdout.write("Published %s and unpublished %s pages." % (
+                len(published), len(unpublished)))
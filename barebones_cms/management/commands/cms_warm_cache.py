@@ -0,0 +1,46 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from barebones_cms.caching import page_cache
+from barebones_cms.warming import PageCacheWarmer
+
+
+class Command(BaseCommand):
+    help = ("Renders published pages into the page cache, most visited "
+            "first, at a limited rate so live traffic is not starved.")
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', default=2,
+                    help="Number of pages rendered at once (default 2)."),
+        make_option('--rate', type='float', default=10,
+                    help="Most pages rendered per second, or 0 for no limit "
+                         "(default 10)."),
+        make_option('--limit', type='int', default=None,
+                    help="Only warm this many of the most visited pages."),
+        make_option('--progress-every', type='int', default=100,
+                    help="Report progress after this many pages (default 100)."),
+    )
+
+    def handle(self, *args, **options):
+        if not page_cache.is_enabled():
+            raise CommandError("The page cache is off. Set BB_CMS_PAGE_CACHE to use it.")
+        if options['workers'] < 1:
+            raise CommandError("--workers must be at least 1.")
+
+        warmer = PageCacheWarmer(workers=options['workers'], rate=options['rate'])
+        paths = warmer.get_paths(options['limit'])
+        self.stdout.write("Warming %s pages." % len(paths))
+        self.progress_every = max(1, options['progress_every'])
+        progress = warmer.warm(paths, self.report_progress)
+        self.stdout.write(
+            "Warmed %s pages, %s were already cached and %s failed in %.1fs "
+            "(%.1f pages/s)." % (
+                progress.counts['warmed'], progress.counts['cached'],
+                progress.counts['failed'], progress.get_elapsed(),
+                progress.get_rate()))
+
+    def report_progress(self, progress):
+        if progress.done % self.progress_every and progress.done != progress.total:
+            return
+        self.stdout.write("%s/%s pages, %.1f pages/s" % (
+            progress.done, progress.total, progress.get_rate()))
@@ -0,0 +1,92 @@
+import json
+import logging
+
+from django.db import connection
+
+from barebones_cms import instrumentation
+from barebones_cms.instrumentation import metrics
+
+
+logger = logging.getLogger('barebones_cms')
+
+
+class CMSInstrumentationMiddleware(object):
+    """ Records how long each stage of serving a CMS page takes and how many
+        queries it runs. The stages are sent back in a Server-Timing header,
+        logged as a JSON line to the barebones_cms logger and added to the
+        in-process metrics. Requests that do not serve a CMS page are left
+        alone.
+    """
+    def process_request(self, request):
+        instrumentation.start_request()
+        if instrumentation.INSTRUMENT_QUERIES:
+            request._cms_use_debug_cursor = connection.use_debug_cursor
+            connection.use_debug_cursor = True
+
+    def process_response(self, request, response):
+        timings = instrumentation.get_timings()
+        instrumentation.set_timings(None)
+        if timings is None or not timings.stages:
+            self.restore_debug_cursor(request)
+            return response
+
+        response['Server-Timing'] = self.get_server_timing(timings)
+        if response.streaming:
+            # Blocks are rendered as the response is sent, so only finish
+            # once it has been
+            response.streaming_content = self.iter_and_finish(
+                request, response, response.streaming_content, timings)
+        else:
+            self.restore_debug_cursor(request)
+            self.finish(request, response, timings)
+        return response
+
+    def iter_and_finish(self, request, response, streaming_content, timings):
+        instrumentation.set_timings(timings)
+        try:
+            for chunk in streaming_content:
+                yield chunk
+        finally:
+            instrumentation.set_timings(None)
+            # Still counting the queries of the blocks rendered while streaming
+            self.restore_debug_cursor(request)
+            self.finish(request, response, timings)
+
+    def restore_debug_cursor(self, request):
+        if hasattr(request, '_cms_use_debug_cursor'):
+            connection.use_debug_cursor = request._cms_use_debug_cursor
+            del request._cms_use_debug_cursor
+
+    def get_server_timing(self, timings):
+        return ', '.join(
+            '%s;dur=%.1f;desc="%s queries"' % (name, duration * 1000, queries)
+            for name, (duration, queries, count) in timings.stages.iteritems())
+
+    def finish(self, request, response, timings):
+        duration = timings.get_duration()
+        self.record_metrics(response, timings, duration)
+        self.log(request, response, timings, duration)
+
+    def record_metrics(self, response, timings, duration):
+        metrics.increment('bb_cms_requests_total',
+                          (('status', response.status_code),))
+        metrics.observe('bb_cms_request_duration_seconds', duration)
+        for name, (stage_duration, queries, count) in timings.stages.iteritems():
+            labels = (('stage', name),)
+            metrics.observe('bb_cms_stage_duration_seconds', stage_duration, labels)
+            metrics.increment('bb_cms_stage_queries_total', labels, queries)
+
+    def log(self, request, response, timings, duration):
+        data = {
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': round(duration * 1000, 1),
+            'stages': dict(
+                (name, {'duration_ms': round(stage_duration * 1000, 1),
+                        'queries': queries,
+                        'count': count})
+                for name, (stage_duration, queries, count)
+                in timings.stages.iteritems()),
+        }
+        data.update(timings.annotations)
+        logger.info(json.dumps(data, sort_keys=True), extra={'cms_timings': data})
@@ -13,6 +13,10 @@ CMS_APP = getattr(settings, 'BB_CMS_APP_NAME', 'apps.cms').split('.')[-1]
 class BasePageTemplate(models.Model):
     name = models.CharField(max_length=200)
     template_file = models.FileField(upload_to='templates/cms/', max_length=200)
+    # Send pages using this template as a stream. Content blocks must be
+    # output as they are, without being passed through filters.
+    stream_response = models.BooleanField(default=False)
+    modified = models.DateTimeField(auto_now=True)
 
     class Meta:
         abstract = True
@@ -26,11 +30,26 @@ class BasePageTemplate(models.Model):
 
 class BasePage(MPTTModel):
     parent = TreeForeignKey('self', null=True, blank=True, related_name='children')
-    title = models.CharField(max_length=255)
-    slug = models.CharField(max_length=100)
+    title = models.CharField(max_length=255, db_index=True)
+    slug = models.CharField(max_length=100, db_index=True)
     page_template = models.ForeignKey("%s.PageTemplate" % CMS_APP, related_name="template")
     is_deleted = models.BooleanField(default=False)
     is_published = models.BooleanField(default=False)
+    # The full slug path of the page while it can be served, otherwise null.
+    # Kept up to date by the PageService so pages resolve in a single query.
+    path = models.CharField(max_length=1000, unique=True, null=True,
+                            blank=True, editable=False)
+    # What the page renders, kept up to date by the render plan signal
+    # handlers when BB_CMS_RENDER_PLANS is on. Empty until first built.
+    render_plan = models.TextField(blank=True, default='', editable=False)
+    # Bumped by every write to the plan, so a plan built from data that has
+    # since changed is never stored over a newer one
+    render_plan_version = models.PositiveIntegerField(default=0, editable=False)
+    # When the scheduler should publish or unpublish the page. Each is
+    # cleared once it has been applied.
+    publish_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    unpublish_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    modified = models.DateTimeField(auto_now=True)
 
     def __unicode__(self):
         if self.parent:
@@ -46,6 +65,7 @@ class BaseRegion(models.Model):
     name = models.CharField(max_length=255)
     block_name = models.CharField(max_length=255)
     template = models.ForeignKey("%s.PageTemplate" % CMS_APP)
+    modified = models.DateTimeField(auto_now=True)
 
     class Meta:
         abstract = True
@@ -60,19 +80,65 @@ class BaseContentBlockLink(models.Model):
     object_id = models.PositiveIntegerField(db_index=True)
     content_type = models.ForeignKey(ContentType, db_index=True)
     model_object = generic.GenericForeignKey('content_type', 'object_id')
+    # Where the block appears within its region on the page
+    position = models.PositiveIntegerField(default=0)
+    # Also touched whenever the linked block is saved through the
+    # ContentBlockService, so a page's links tell when its blocks changed
+    modified = models.DateTimeField(auto_now=True)
 
     class Meta:
         abstract = True
+        # Links are read a page at a time in region and position order
+        index_together = [('page', 'region', 'position')]
 
 
 class BaseContentBlock(models.Model):
     name = models.CharField(max_length=255)
     partial = models.FileField(upload_to='templates/cms/', max_length=200)
     order = models.IntegerField(null=True, blank=True)
+    # Bumped every time the block is saved through the ContentBlockService.
+    # Used to key the cached copies of the rendered partial.
+    version = models.PositiveIntegerField(default=1, editable=False)
+    modified = models.DateTimeField(auto_now=True)
+
+    # Set to True on blocks that load extra data in prefetch_data, such as
+    # a remote feed, so the concurrent renderer can load them side by side
+    prefetches_data = False
 
     class Meta:
         abstract = True
 
+    def prefetch_data(self):
+        """ Loads anything the partial needs before the block is rendered.
+            Only called when prefetches_data is True.
+        """
+        pass
+
+
+class BasePageSnapshot(models.Model):
+    """ A published copy of a page's content: the page, its template and
+        regions and the blocks of each region in order, serialized as JSON.
+        At most one snapshot of each page is live at a time.
+    """
+    page = models.ForeignKey("%s.Page" % CMS_APP, related_name='snapshots')
+    version = models.PositiveIntegerField()
+    is_live = models.BooleanField(default=False)
+    content = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+    # When the snapshot last went live, by being published or rolled back to
+    live_since = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        abstract = True
+        unique_together = [('page', 'version')]
+        index_together = [('page', 'is_live')]
+
+    def __unicode__(self):
+        return "%s v%s" % (self.page_id, self.version)
+
+    def __str__(self):
+        return self.__unicode__()
+
 
 # Content Blocks
 class SimpleContentBlock(BaseContentBlock):
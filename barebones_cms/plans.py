@@ -0,0 +1,158 @@
+import json
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import F
+from django.db.models.loading import get_model
+from django.db.models.signals import post_delete, post_save
+
+from barebones_cms.registry import content_block_registry
+from barebones_cms.services import PageService
+
+
+# Allow the cms app to be completely overridden with another namespace
+CMS_APP = getattr(settings, 'BB_CMS_APP_NAME', 'apps.cms').split('.')[-1]
+# Store what each page renders and serve pages from it
+RENDER_PLANS_ENABLED = getattr(settings, 'BB_CMS_RENDER_PLANS', False)
+# Bumped whenever the layout of a stored plan changes. Plans in any other
+# format are rebuilt when they are next used.
+RENDER_PLAN_FORMAT = 1
+
+
+Page = get_model(CMS_APP, 'Page')
+PageTemplate = get_model(CMS_APP, 'PageTemplate')
+Region = get_model(CMS_APP, 'Region')
+ContentBlockLink = get_model(CMS_APP, 'ContentBlockLink')
+
+
+class RenderPlan(object):
+    """ A page's template, regions and the blocks of each region, loaded
+        from a stored plan. The template and regions are unsaved objects
+        holding only what rendering needs.
+    """
+    def __init__(self, page_template, regions, region_blocks):
+        self.page_template = page_template
+        self.regions = regions
+        # Lists of (content type pk, block pk, version, partial) by region pk
+        self.region_blocks = region_blocks
+
+
+class RenderPlanService(object):
+    """ Builds and loads the render plans stored on pages.
+
+        A plan is a compact JSON array of the page template, then each
+        region with the blocks linked to it in order. Saving a page or one
+        of its links rebuilds its plan straight away. Changes that can touch
+        many pages, such as saving a template, region or block, just empty
+        the plans involved so each is rebuilt the next time it is served.
+    """
+    def is_enabled(self):
+        return RENDER_PLANS_ENABLED
+
+    def get_plan(self, page):
+        data, version = Page.objects.filter(pk=page.pk).values_list(
+            'render_plan', 'render_plan_version').first() or ('', None)
+        plan = json.loads(data) if data else None
+        if plan is None or plan[0] != RENDER_PLAN_FORMAT:
+            plan = self.build_plan(page)
+            # An editor may have changed the page while the plan was built
+            self.store_plan(page, plan, expected_version=version)
+        return self.load_plan(plan)
+
+    def build_plan(self, page):
+        page_service = PageService()
+        page_template = PageTemplate.objects.get(pk=page.page_template_id)
+        block_links = page_service.get_block_links_for_page(page)
+        blocks = page_service.get_blocks_for_links(block_links)
+        region_blocks = {}
+        for link in block_links:
+            block = blocks.get((link.content_type_id, link.object_id))
+            if block is not None:
+                region_blocks.setdefault(link.region_id, []).append(
+                    [link.content_type_id, block.pk, block.version,
+                     block.partial.name])
+
+        regions = page_template.region_set.all()
+        return [RENDER_PLAN_FORMAT,
+                [page_template.pk, page_template.template_file.name,
+                 page_template.stream_response],
+                [[region.pk, region.block_name, region_blocks.get(region.pk, [])]
+                 for region in regions]]
+
+    def store_plan(self, page, plan, expected_version=None):
+        """ Stores a plan on a page. With an expected version the plan is
+            only stored if nothing else has written the page's plan since
+            that version was read, and True is returned if it was.
+        """
+        pages = Page.objects.filter(pk=page.pk)
+        if expected_version is not None:
+            pages = pages.filter(render_plan_version=expected_version)
+        # Updating rather than saving keeps the signal handlers out of it
+        return bool(pages.update(
+            render_plan=json.dumps(plan, separators=(',', ':')),
+            render_plan_version=F('render_plan_version') + 1))
+
+    def load_plan(self, plan):
+        format_version, template_data, regions_data = plan
+        pk, template_file, stream_response = template_data
+        page_template = PageTemplate(
+            pk=pk, template_file=template_file, stream_response=stream_response)
+        regions = []
+        region_blocks = {}
+        for pk, block_name, block_refs in regions_data:
+            regions.append(Region(pk=pk, block_name=block_name))
+            region_blocks[pk] = [tuple(block_ref) for block_ref in block_refs]
+        return RenderPlan(page_template, regions, region_blocks)
+
+    def rebuild_plan(self, page):
+        self.store_plan(page, self.build_plan(page))
+
+    def clear_plans(self, pages):
+        # Empty plans are bumped too, as one may be being built right now
+        pages.update(render_plan='',
+                     render_plan_version=F('render_plan_version') + 1)
+
+
+def page_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        RenderPlanService().rebuild_plan(instance)
+
+
+def link_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    # The page is gone if the link is being deleted along with it
+    page = Page.objects.filter(pk=instance.page_id).first()
+    if page is not None:
+        RenderPlanService().rebuild_plan(page)
+
+
+def page_template_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        RenderPlanService().clear_plans(
+            Page.objects.filter(page_template=instance.pk))
+
+
+def region_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        RenderPlanService().clear_plans(
+            Page.objects.filter(page_template=instance.template_id))
+
+
+def block_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        content_type = ContentType.objects.get_for_model(instance)
+        RenderPlanService().clear_plans(Page.objects.filter(
+            contentblocklink__content_type=content_type,
+            contentblocklink__object_id=instance.pk))
+
+
+def connect_signals():
+    """ Keeps render plans up to date. Called when the app is ready. """
+    post_save.connect(page_saved, sender=Page)
+    for signal in (post_save, post_delete):
+        signal.connect(link_changed, sender=ContentBlockLink)
+        signal.connect(page_template_changed, sender=PageTemplate)
+        signal.connect(region_changed, sender=Region)
+        for model in content_block_registry.get_models():
+            signal.connect(block_changed, sender=model)
@@ -0,0 +1,79 @@
+import threading
+from collections import OrderedDict
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.forms.models import modelform_factory
+
+from barebones_cms.models import BaseContentBlock
+
+
+class ContentBlockRegistry(object):
+    """ Keeps track of the content block models that can be added to pages.
+
+        Blocks in the CMS app are registered when the app registry is ready.
+        Blocks living in any other app can be added with register. Content
+        type ids and model forms are worked out once and then kept.
+    """
+    def __init__(self):
+        self._models = []
+        self._content_types = None
+        self._form_classes = {}
+        self._lock = threading.Lock()
+
+    def register(self, model_class):
+        if not issubclass(model_class, BaseContentBlock):
+            raise ImproperlyConfigured(
+                "%s is not a content block" % model_class.__name__)
+        with self._lock:
+            if model_class not in self._models:
+                self._models.append(model_class)
+                self._content_types = None
+        return model_class
+
+    def register_app(self, app_config):
+        for model_class in app_config.get_models():
+            if issubclass(model_class, BaseContentBlock):
+                self.register(model_class)
+
+    def get_models(self):
+        return list(self._models)
+
+    def get_content_types(self):
+        """ Returns a dict of content type id to model class. The content
+            types are looked up the first time this is called.
+        """
+        content_types = self._content_types
+        if content_types is None:
+            content_types = OrderedDict(
+                (ContentType.objects.get_for_model(model_class).pk, model_class)
+                for model_class in self.get_models())
+            self._content_types = content_types
+        return content_types
+
+    def get_model(self, content_type_id):
+        try:
+            return self.get_content_types()[int(content_type_id)]
+        except (KeyError, ValueError):
+            raise LookupError(
+                "No content block is registered for content type %s" %
+                content_type_id)
+
+    def get_verbose_name(self, model_class):
+        return model_class._meta.verbose_name.title()
+
+    def get_choices(self):
+        """ Returns (verbose name, content type id) for each block model """
+        return [(self.get_verbose_name(model_class), content_type_id)
+                for content_type_id, model_class
+                in self.get_content_types().items()]
+
+    def get_form_class(self, model_class):
+        form_class = self._form_classes.get(model_class)
+        if form_class is None:
+            form_class = modelform_factory(model_class)
+            self._form_classes[model_class] = form_class
+        return form_class
+
+
+content_block_registry = ContentBlockRegistry()
@@ -0,0 +1,247 @@
+import re
+import threading
+import uuid
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+from django.template import RequestContext
+from django.utils.safestring import mark_safe
+
+from barebones_cms.caching import fragment_cache
+from barebones_cms.instrumentation import stage
+from barebones_cms.loading import template_cache
+from barebones_cms.services import PageService, RegionService
+
+
+# Stands in for a content block when a page is streamed
+BLOCK_PLACEHOLDER = '<!--bb-cms-block:%s:%s-->'
+# Number of threads the concurrent renderer loads content with
+CONCURRENT_WORKERS = getattr(settings, 'BB_CMS_CONCURRENT_WORKERS', 4)
+
+
+class PageRenderer(object):
+    """ Renders a page and its content blocks.
+
+        A single context is shared by every block and the page template.
+        Each block pushes its own layer for the duration of its render, so
+        nothing is copied however many regions and blocks the page has.
+    """
+    def __init__(self, request, page):
+        self.request = request
+        self.page = page
+        self.context = RequestContext(request, {'page': page})
+
+    def render(self):
+        self.load_blocks()
+        for region in self.regions:
+            rendered_blocks = list(self.iter_rendered_blocks(
+                self.region_blocks.get(region.pk, [])))
+            self.context[region.block_name] = {'content_blocks': rendered_blocks}
+        fragment_cache.set_many(self.new_fragments)
+        with stage('render'):
+            return self.get_page_template().render(self.context)
+
+    def stream(self):
+        """ Renders the page template straight away with a placeholder for
+            each content block and returns a generator of the output. Blocks
+            are only rendered once the output before them has been sent.
+        """
+        self.load_blocks()
+        marker = uuid.uuid4().hex
+        placeholder_blocks = []
+        for region in self.regions:
+            placeholders = []
+            for block in self.region_blocks.get(region.pk, []):
+                placeholders.append(mark_safe(
+                    BLOCK_PLACEHOLDER % (marker, len(placeholder_blocks))))
+                placeholder_blocks.append(block)
+            self.context[region.block_name] = {'content_blocks': placeholders}
+
+        with stage('render'):
+            output = self.get_page_template().render(self.context)
+        # Splitting on the captured index leaves text at the even positions
+        parts = re.split(BLOCK_PLACEHOLDER % (marker, r'(\d+)'), output)
+        return self.iter_stream(parts, placeholder_blocks)
+
+    def iter_stream(self, parts, placeholder_blocks):
+        rendered_blocks = {}
+        for position, part in enumerate(parts):
+            if position % 2 == 0:
+                if part:
+                    yield part
+                continue
+            index = int(part)
+            if index not in rendered_blocks:
+                rendered_blocks[index] = self.render_block(placeholder_blocks[index])
+            yield rendered_blocks[index]
+        fragment_cache.set_many(self.new_fragments)
+
+    def is_streamed(self):
+        return self.page.page_template.stream_response
+
+    def get_page_template(self):
+        return template_cache.get_template(self.page.page_template.template_file)
+
+    def load_blocks(self):
+        with stage('regions'):
+            self.regions = list(RegionService().get_regions_for_page(self.page))
+        with stage('blocks'):
+            self.region_blocks = PageService().get_content_blocks_for_page(self.page)
+            self.load_fragments()
+            self.prefetch_blocks()
+
+    def load_fragments(self):
+        self.cached_fragments = fragment_cache.get_many(
+            [block for blocks in self.region_blocks.values() for block in blocks])
+        self.new_fragments = {}
+
+    def prefetch_blocks(self):
+        for block in self.get_blocks_to_prefetch():
+            block.prefetch_data()
+
+    def get_blocks_to_prefetch(self):
+        # Blocks with a cached fragment are not going to be rendered
+        return [block
+                for blocks in self.region_blocks.values() for block in blocks
+                if block.prefetches_data and
+                fragment_cache.get_key(block) not in self.cached_fragments]
+
+    def iter_rendered_blocks(self, blocks):
+        for block in blocks:
+            yield self.render_block(block)
+
+    def render_block(self, block):
+        fragment_key = fragment_cache.get_key(block)
+        if fragment_key in self.cached_fragments:
+            return mark_safe(self.cached_fragments[fragment_key])
+
+        with stage('block.%s' % block._meta.model_name):
+            block_template = template_cache.get_template(block.partial)
+            with self.context.push(content_block=block):
+                rendered_block = block_template.render(self.context)
+        self.new_fragments[fragment_key] = rendered_block
+        return rendered_block
+
+
+class SnapshotPageRenderer(PageRenderer):
+    """ Renders the live snapshot of a page. Everything is already loaded
+        in the LivePage, so no queries are needed for the page's content.
+    """
+    def __init__(self, request, live_page):
+        super(SnapshotPageRenderer, self).__init__(request, live_page.page)
+        self.live_page = live_page
+
+    def load_blocks(self):
+        self.regions = self.live_page.regions
+        self.region_blocks = self.live_page.region_blocks
+        with stage('blocks'):
+            self.load_fragments()
+            self.prefetch_blocks()
+
+
+class PlanPageRenderer(PageRenderer):
+    """ Renders a page from its stored render plan, so the template,
+        regions and links are never loaded. Blocks whose rendered partial is
+        in the fragment cache are not loaded either.
+    """
+    def __init__(self, request, page, plan):
+        super(PlanPageRenderer, self).__init__(request, page)
+        self.plan = plan
+
+    def is_streamed(self):
+        return self.plan.page_template.stream_response
+
+    def get_page_template(self):
+        return template_cache.get_template(self.plan.page_template.template_file)
+
+    @stage('blocks')
+    def load_blocks(self):
+        self.regions = self.plan.regions
+        # Start with unsaved stand-ins, which are enough to find fragments
+        stand_ins = {}
+        for block_refs in self.plan.region_blocks.values():
+            for content_type_id, pk, version, partial in block_refs:
+                model = ContentType.objects.get_for_id(content_type_id).model_class()
+                stand_ins[(content_type_id, pk)] = model(
+                    pk=pk, version=version, partial=partial)
+        self.cached_fragments = fragment_cache.get_many(stand_ins.values())
+        self.new_fragments = {}
+
+        missing = set(key for key, block in stand_ins.iteritems()
+                      if fragment_cache.get_key(block) not in self.cached_fragments)
+        object_ids = {}
+        for content_type_id, pk in missing:
+            object_ids.setdefault(content_type_id, set()).add(pk)
+        service = PageService()
+        blocks = dict((key, block) for key, block in stand_ins.iteritems()
+                      if key not in missing)
+        for content_type_id, ids in object_ids.iteritems():
+            blocks.update(service.get_blocks_of_type(content_type_id, ids))
+
+        self.region_blocks = {}
+        for region_pk, block_refs in self.plan.region_blocks.iteritems():
+            # Blocks deleted since the plan was built are skipped
+            self.region_blocks[region_pk] = [
+                blocks[(content_type_id, pk)]
+                for content_type_id, pk, version, partial in block_refs
+                if (content_type_id, pk) in blocks]
+        self.prefetch_blocks()
+
+
+def call_with_connection(func, *args):
+    """ Runs a function on a pool thread. Threads get their own database
+        connection and keep it between tasks. It is only dropped at the
+        start of a task if it is broken or older than a CONN_MAX_AGE above
+        zero, as opening one per task would undo loading side by side.
+    """
+    for connection in connections.all():
+        if connection.settings_dict['CONN_MAX_AGE'] == 0:
+            # Requests close these when they finish, pool threads never do
+            connection.close_at = None
+        connection.close_if_unusable_or_obsolete()
+    return func(*args)
+
+
+class ConcurrentPageRenderer(PageRenderer):
+    """ A PageRenderer that loads the regions, the blocks of each content
+        type and the data of blocks that prefetch it side by side on a
+        thread pool. The rendered output is identical.
+    """
+    _pool = None
+    _pool_lock = threading.Lock()
+
+    @classmethod
+    def get_pool(cls):
+        with cls._pool_lock:
+            if cls._pool is None:
+                cls._pool = ThreadPool(CONCURRENT_WORKERS)
+        return cls._pool
+
+    @stage('blocks')
+    def load_blocks(self):
+        pool = self.get_pool()
+        service = PageService()
+        regions = pool.apply_async(call_with_connection, (self.get_regions,))
+
+        block_links = service.get_block_links_for_page(self.page)
+        object_ids = service.get_block_ids_by_content_type(block_links)
+        batches = [pool.apply_async(call_with_connection,
+                                    (service.get_blocks_of_type,
+                                     content_type_id, ids))
+                   for content_type_id, ids in object_ids.iteritems()]
+        blocks = {}
+        for batch in batches:
+            blocks.update(batch.get())
+        self.region_blocks = service.group_blocks_by_region(block_links, blocks)
+        self.regions = regions.get()
+
+        self.load_fragments()
+        prefetches = [pool.apply_async(call_with_connection, (block.prefetch_data,))
+                      for block in self.get_blocks_to_prefetch()]
+        for prefetch in prefetches:
+            prefetch.get()
+
+    def get_regions(self):
+        return list(RegionService().get_regions_for_page(self.page))
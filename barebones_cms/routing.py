@@ -0,0 +1,77 @@
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.loading import get_model
+
+
+# Allow the cms app to be completely overridden with another namespace
+CMS_APP = getattr(settings, 'BB_CMS_APP_NAME', 'apps.cms').split('.')[-1]
+# The cache backend (from CACHES) used by the CMS. Read here rather than from
+# caching, which imports this module.
+CACHE_ALIAS = getattr(settings, 'BB_CMS_CACHE', 'default')
+# Shared cache key holding the current version of the route index. Bumping it
+# tells every process to rebuild its own copy on the next lookup.
+ROUTE_INDEX_VERSION_KEY = 'bb_cms:route_index_version'
+
+
+Page = get_model(CMS_APP, 'Page')
+
+
+def normalise_path(path):
+    """ Turns a request path such as '/a/b/c/' into the 'a/b/c' form used as
+        the key of the route index.
+    """
+    return path.lstrip('/').rstrip('/')
+
+
+class PageRouteIndex(object):
+    """ An in-memory map of full slug paths to published pages.
+
+        The index is built from the stored page paths in a single query and
+        is rebuilt lazily whenever the shared version stored in the cache no
+        longer matches the version it was built against.
+    """
+    def __init__(self):
+        self._routes = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def get_page(self, path):
+        version = self.get_version()
+        routes = self._routes
+        if routes is None or version != self._version:
+            routes = self.rebuild(version)
+        return routes.get(normalise_path(path))
+
+    def get_version(self):
+        cache = caches[CACHE_ALIAS]
+        version = cache.get(ROUTE_INDEX_VERSION_KEY)
+        if version is None:
+            # The key was never set or has been evicted. Make sure every
+            # process agrees on the same version from here on.
+            cache.add(ROUTE_INDEX_VERSION_KEY, uuid.uuid4().hex, None)
+            version = cache.get(ROUTE_INDEX_VERSION_KEY)
+        return version
+
+    def rebuild(self, version):
+        with self._lock:
+            if self._routes is not None and self._version == version:
+                # Another thread got here first
+                return self._routes
+            routes = self.build_routes()
+            self._routes, self._version = routes, version
+        return routes
+
+    def build_routes(self):
+        # Render plans are read on their own when needed and can be large
+        pages = Page.objects.exclude(path=None).defer('render_plan')
+        return dict((page.path, page) for page in pages)
+
+    def invalidate(self):
+        self._routes = None
+        caches[CACHE_ALIAS].set(ROUTE_INDEX_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+page_route_index = PageRouteIndex()
@@ -1,19 +1,34 @@
-from django.core.exceptions import MultipleObjectsReturned
-from django.core.urlresolvers import reverse_lazy
+import hashlib
+
+from django.core.urlresolvers import (
+    get_resolver, get_script_prefix, get_urlconf, reverse)
+from django.db import transaction
+from django.db.models import Count, F, Max, Min, Q
+from django.utils import timezone
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.db.models.loading import get_model
 from django.forms import model_to_dict
-from django.apps import apps
-
-from barebones_cms.models import BaseContentBlock
 
+from barebones_cms.caching import page_cache
+from barebones_cms.db import bulk_update_field, bulk_update_fields
+from barebones_cms.loading import template_cache
+from barebones_cms.registry import content_block_registry
+from barebones_cms.routing import page_route_index, normalise_path
 
 
 # Allow the cms app to be completely overridden with another namespace
 CMS_APP = getattr(settings, 'BB_CMS_APP_NAME', 'apps.cms').split('.')[-1]
 # Allow url namespacing for the dashboard
 DASHBOARD_NAMESPACE = getattr(settings, 'BB_DASHBOARD_NAMESPACE', None)
+# Resolve page paths from an in-memory route index instead of the database.
+# Off by default as every process has to share the CMS cache to see changes.
+ROUTE_INDEX_ENABLED = getattr(settings, 'BB_CMS_ROUTE_INDEX', False)
+# Number of scheduled pages published or unpublished per transaction
+SCHEDULE_BATCH_SIZE = 500
+# Fields returned for each page by the page tree listings
+PAGE_LISTING_FIELDS = (
+    'pk', 'title', 'slug', 'is_published', 'is_deleted', 'tree_id', 'lft', 'rght')
 
 
 # Import models using get_model so we get the right ones
@@ -25,66 +40,135 @@ ContentBlockLink = get_model(CMS_APP, 'ContentBlockLink')
 
 class PageService(object):
     def get_page_from_path(self, path):
-        # Get rid of leading and ending slashes. Then split the path into parts
-        parts = path.lstrip('/').rstrip('/').split('/')
+        if ROUTE_INDEX_ENABLED:
+            return page_route_index.get_page(path)
 
-        # Get the root page for the path
         try:
-            root_page = self.get_root_page_by_slug(parts.pop(0))
-        except (Page.DoesNotExist, MultipleObjectsReturned):
-            # At least one slug failed to match. Return nothing
-            return
-
-        if not parts:
-            # If there are no more parts, this was a root page
-            return root_page
-        parent_page = root_page
-
-        # Be greedy! In some cases it would be more efficient to be lazy, but
-        # being greedy will always ensure the correct page is returned.
-        try:
-            page = self.get_published_child(root_page, parts)
-        except (Page.DoesNotExist, MultipleObjectsReturned):
-            # At least one slug failed to match. Return nothing
+            # Only rendering reads the plan, and it loads it separately
+            return Page.objects.defer('render_plan').get(
+                path=normalise_path(path))
+        except Page.DoesNotExist:
             return
-        return page
-
-    def get_published_child(self, parent_page, slug_parts):
-        page_slug = slug_parts.pop(0)
-        page = parent_page.children.get(
-            slug=page_slug, is_deleted=False, is_published=True)
-        if not slug_parts:
-            return page
-        # Otherwise recurse
-        return self.get_published_child(page, slug_parts)
-
-    def get_root_page_by_slug(self, slug):
-        try:
-            page = Page.objects.get(
-                slug=slug, parent=None, is_deleted=False, is_published=True)
-        except MultipleObjectsReturned:
-            # Something is very wrong. There is most likely a data integrity
-            # problem!
-            raise
-        return page
 
     def get_content_blocks_for_region(self, region, page):
-        block_links = ContentBlockLink.objects.filter(region=region, page=page)
-        return [block.model_object for block in block_links]
+        block_links = list(ContentBlockLink.objects.filter(
+            region=region, page=page).order_by('position', 'pk'))
+        blocks = self.get_blocks_for_links(block_links)
+        return [blocks[link.content_type_id, link.object_id]
+                for link in block_links
+                if (link.content_type_id, link.object_id) in blocks]
 
     def get_content_blocks_info_for_region(self, region, page):
-        block_links = ContentBlockLink.objects.filter(region=region, page=page)
-        region_blocks = []
-        for block in block_links:
-            block_dict = {
-                'model_object': block.model_object,
-                'content_type': block.content_type.pk}
-            region_blocks.append(block_dict)
+        block_links = list(ContentBlockLink.objects.filter(
+            region=region, page=page).order_by('position', 'pk'))
+        blocks = self.get_blocks_for_links(block_links)
+        return [{'model_object': blocks.get((link.content_type_id, link.object_id)),
+                 'content_type': link.content_type_id,
+                 'link': link.pk}
+                for link in block_links]
+
+    def get_content_blocks_for_page(self, page):
+        """ Returns the content blocks of every region of a page as a dict
+            keyed by region pk, keeping the order of the links.
+        """
+        block_links = self.get_block_links_for_page(page)
+        blocks = self.get_blocks_for_links(block_links)
+        return self.group_blocks_by_region(block_links, blocks)
+
+    def group_blocks_by_region(self, block_links, blocks):
+        region_blocks = {}
+        for link in block_links:
+            block = blocks.get((link.content_type_id, link.object_id))
+            if block is not None:
+                region_blocks.setdefault(link.region_id, []).append(block)
+        return region_blocks
+
+    def get_content_blocks_info_for_page(self, page):
+        """ The same as get_content_blocks_for_page but in the format used by
+            get_content_blocks_info_for_region
+        """
+        block_links = self.get_block_links_for_page(page)
+        blocks = self.get_blocks_for_links(block_links)
+        region_blocks = {}
+        for link in block_links:
+            region_blocks.setdefault(link.region_id, []).append({
+                'model_object': blocks.get((link.content_type_id, link.object_id)),
+                'content_type': link.content_type_id,
+                'link': link.pk})
         return region_blocks
 
+    def get_block_links_for_page(self, page):
+        # Served by the (page, region, position) index
+        return list(ContentBlockLink.objects.filter(page=page).order_by(
+            'region', 'position', 'pk'))
+
+    def get_blocks_for_links(self, block_links):
+        """ Fetches the blocks behind a list of links with one query per
+            content type, instead of one query per link through the generic
+            foreign key. Returns a dict keyed by (content type pk, block pk).
+        """
+        blocks = {}
+        object_ids = self.get_block_ids_by_content_type(block_links)
+        for content_type_id, ids in object_ids.iteritems():
+            blocks.update(self.get_blocks_of_type(content_type_id, ids))
+        return blocks
+
+    def get_block_ids_by_content_type(self, block_links):
+        object_ids = {}
+        for link in block_links:
+            object_ids.setdefault(link.content_type_id, set()).add(link.object_id)
+        return object_ids
+
+    def get_blocks_of_type(self, content_type_id, ids):
+        # get_for_id is served from the content type cache
+        model_class = ContentType.objects.get_for_id(
+            content_type_id).model_class()
+        blocks = model_class._default_manager.in_bulk(ids)
+        return dict(((content_type_id, pk), block)
+                    for pk, block in blocks.iteritems())
+
     def get_all_active_root_pages(self):
         return Page.objects.filter(is_deleted=False, parent=None)
 
+    def get_root_page_listing(self, after_tree_id=None, limit=100):
+        """ Returns up to limit active root pages, as dicts, ordered by tree
+            and starting after the given tree id
+        """
+        pages = self.get_all_active_root_pages().order_by('tree_id')
+        if after_tree_id is not None:
+            pages = pages.filter(tree_id__gt=after_tree_id)
+        return list(pages.values(*PAGE_LISTING_FIELDS)[:limit])
+
+    def get_child_page_listing(self, parent_pk, after_lft=None, limit=100):
+        """ Returns up to limit children of a page, as dicts, in tree order
+            and starting after the given left value
+        """
+        pages = Page.objects.filter(parent=parent_pk).order_by('lft')
+        if after_lft is not None:
+            pages = pages.filter(lft__gt=after_lft)
+        return list(pages.values(*PAGE_LISTING_FIELDS)[:limit])
+
+    def search_page_listing(self, prefix, after_pk=None, limit=100):
+        """ Returns up to limit pages, as dicts, whose slug or title starts
+            with the prefix, ordered by pk and starting after the given pk
+        """
+        pages = self.get_pages().filter(
+            Q(slug__startswith=prefix) | Q(title__startswith=prefix)
+        ).order_by('pk')
+        if after_pk is not None:
+            pages = pages.filter(pk__gt=after_pk)
+        return list(pages.values(*PAGE_LISTING_FIELDS)[:limit])
+
+    def get_page_tree_nodes(self):
+        """ Returns (pk, slug, tree_id, lft, rght, level) for every page in
+            the trees of the active root pages, in tree order, using a single
+            query.
+        """
+        root_trees = self.get_all_active_root_pages().values('tree_id')
+        return Page.objects.filter(tree_id__in=root_trees).order_by(
+            'tree_id', 'lft').values_list(
+            'pk', 'slug', 'tree_id', 'lft', 'rght', 'level')
+
     def get_page_templates(self):
         return PageTemplate.objects.all()
 
@@ -100,19 +184,31 @@ class PageService(object):
 
     def edit_page_template(self, template_pk, **fields_to_update):
         page_template = self.get_page_template_by_pk(template_pk)
+        old_template_name = page_template.template_file.name
         for field_name, value in fields_to_update.iteritems():
             setattr(page_template, field_name, value)
         page_template.save()
+        template_cache.invalidate(old_template_name,
+                                  page_template.template_file.name)
+        # Pages in the route index hold on to their page template
+        page_route_index.invalidate()
+        page_cache.invalidate_pages(
+            Page.objects.filter(page_template=page_template))
         return page_template
 
     def create_page(self, title, slug, page_template, parent=None,
                     is_published=False, **extra_fields):
-        return Page.objects.create(title=title,
-                                   slug=slug,
-                                   page_template=page_template,
-                                   parent=parent,
-                                   is_published=is_published,
-                                   **extra_fields)
+        with transaction.atomic():
+            page = Page.objects.create(title=title,
+                                       slug=slug,
+                                       page_template=page_template,
+                                       parent=parent,
+                                       is_published=is_published,
+                                       **extra_fields)
+            changed_paths = self.update_page_paths(page) if is_published else set()
+        # Invalidate once committed so nothing is rebuilt from the old rows
+        self.invalidate_page_paths(changed_paths)
+        return page
 
     def check_slug_conflict(self, slug, parent, page_pk=None):
         """ Tries to find a conflicting slug. If the parent has a child with
@@ -143,19 +239,377 @@ class PageService(object):
                                 **extra_fields)
 
     def edit_page(self, page_pk, **fields_to_update):
-        page = self.get_page_by_pk(page_pk)
-        is_published = fields_to_update.get('is_published', page.is_published)
-        slug = fields_to_update.get('slug', page.slug)
-        parent = fields_to_update.get('parent', page.parent)
-        if is_published:
-            conflicts = self.check_slug_conflict(slug, parent, page_pk=page_pk)
-            if conflicts:
-                raise PageConflictingSlugException
-        for field_name, value in fields_to_update.iteritems():
-            setattr(page, field_name, value)
-        page.save()
+        with transaction.atomic():
+            page = self.get_page_by_pk(page_pk)
+            is_published = fields_to_update.get('is_published', page.is_published)
+            slug = fields_to_update.get('slug', page.slug)
+            parent = fields_to_update.get('parent', page.parent)
+            if is_published:
+                conflicts = self.check_slug_conflict(slug, parent, page_pk=page_pk)
+                if conflicts:
+                    raise PageConflictingSlugException
+            for field_name, value in fields_to_update.iteritems():
+                setattr(page, field_name, value)
+            page.save()
+            changed_paths = self.update_page_paths(page)
+        # Edits to drafts leave no served path changed and invalidate nothing
+        self.invalidate_page_paths(changed_paths)
         return page
 
+    def publish_subtree(self, page_pk):
+        """ Publishes a page and every page below it. Raises a
+            PageConflictingSlugException, leaving everything as it was, if
+            that would give two published siblings the same slug.
+        """
+        with transaction.atomic():
+            page = self.get_page_by_pk(page_pk)
+            self.get_subtree(page).update(is_published=True,
+                                          modified=timezone.now())
+            # Only the page itself can clash with pages outside the subtree
+            self.check_slug_conflicts(Page.objects.filter(
+                Q(parent=page.parent_id) | self.get_subtree_q(page)))
+            changed_paths = self.update_page_paths(page)
+        self.invalidate_page_paths(changed_paths)
+
+    def unpublish_subtree(self, page_pk):
+        with transaction.atomic():
+            page = self.get_page_by_pk(page_pk)
+            self.get_subtree(page).update(is_published=False,
+                                          modified=timezone.now())
+            changed_paths = self.update_page_paths(page)
+        self.invalidate_page_paths(changed_paths)
+
+    def delete_subtree(self, page_pk):
+        """ Soft deletes a page and every page below it """
+        with transaction.atomic():
+            page = self.get_page_by_pk(page_pk)
+            self.get_subtree(page).update(is_deleted=True,
+                                          modified=timezone.now())
+            changed_paths = self.update_page_paths(page)
+        self.invalidate_page_paths(changed_paths)
+
+    def move_pages(self, page_pks, parent_pk=None):
+        """ Moves pages, along with the pages below them, to the end of the
+            children of a new parent, or to the top level if there is none.
+            The affected trees are rebuilt once rather than per page.
+        """
+        with transaction.atomic():
+            parent = parent_pk and self.get_page_by_pk(parent_pk)
+            pages = Page.objects.filter(pk__in=page_pks)
+            moved = list(pages.values_list('pk', 'tree_id', 'lft', 'rght'))
+            for pk, tree_id, lft, rght in moved:
+                if parent and parent.tree_id == tree_id and \
+                        lft <= parent.lft and parent.rght <= rght:
+                    raise InvalidPageMoveException
+            pages.update(parent=parent, modified=timezone.now())
+            self.check_slug_conflicts(Page.objects.filter(parent=parent))
+
+            tree_ids = set(tree_id for pk, tree_id, lft, rght in moved)
+            if parent:
+                tree_ids.add(parent.tree_id)
+            self.rebuild_page_tree(tree_ids, moved_pks=[row[0] for row in moved])
+
+            if parent:
+                changed_paths = self.update_page_paths(parent)
+            else:
+                changed_paths = set()
+                for page in pages:
+                    changed_paths.update(self.update_page_paths(page))
+        self.invalidate_page_paths(changed_paths)
+
+    def get_subtree_q(self, page):
+        return Q(tree_id=page.tree_id, lft__gte=page.lft, rght__lte=page.rght)
+
+    def get_subtree(self, page):
+        return Page.objects.filter(self.get_subtree_q(page))
+
+    def check_slug_conflicts(self, pages):
+        """ Raises a PageConflictingSlugException if any published pages
+            in a queryset share both their parent and slug. Checks every
+            pair with one grouped query.
+        """
+        conflicts = pages.filter(is_published=True).order_by().values(
+            'parent', 'slug').annotate(page_count=Count('pk')).filter(
+            page_count__gt=1)
+        if list(conflicts[:1]):
+            raise PageConflictingSlugException
+
+    def invalidate_page_paths(self, changed_paths):
+        """ Drops the route index and cached pages after paths have changed.
+            Does nothing when no served page was affected, so other processes
+            keep their route index.
+        """
+        if not changed_paths:
+            return
+        page_route_index.invalidate()
+        page_cache.invalidate_paths(changed_paths)
+
+    def apply_scheduled_transitions(self, now=None):
+        """ Publishes and unpublishes every page whose publish_at or
+            unpublish_at time has passed, a batch at a time. Pages that would
+            clash with a published sibling's slug are left unpublished.
+            Returns the pks of the published, unpublished and clashing pages.
+        """
+        now = now or timezone.now()
+        published, unpublished, conflicts = [], [], []
+        while True:
+            with transaction.atomic():
+                due = list(Page.objects.filter(publish_at__lte=now).order_by(
+                    'publish_at', 'pk').values_list(
+                    'pk', 'parent_id', 'slug')[:SCHEDULE_BATCH_SIZE])
+                publish_pks, conflict_pks = self.get_publishable_pages(due)
+                Page.objects.filter(pk__in=publish_pks).update(
+                    is_published=True, publish_at=None, modified=now)
+                Page.objects.filter(pk__in=conflict_pks).update(publish_at=None)
+
+                unpublish_pks = list(Page.objects.filter(
+                    unpublish_at__lte=now).order_by('unpublish_at', 'pk').values_list(
+                    'pk', flat=True)[:SCHEDULE_BATCH_SIZE])
+                Page.objects.filter(pk__in=unpublish_pks).update(
+                    is_published=False, unpublish_at=None, modified=now)
+
+                changed_paths = self.update_paths_of_pages(
+                    publish_pks + unpublish_pks)
+            if publish_pks or unpublish_pks:
+                self.invalidate_page_paths(changed_paths)
+
+            published.extend(publish_pks)
+            unpublished.extend(unpublish_pks)
+            conflicts.extend(conflict_pks)
+            if not due and not unpublish_pks:
+                return published, unpublished, conflicts
+
+    def get_publishable_pages(self, pages):
+        """ Splits (pk, parent_id, slug) rows into the pks of pages that can
+            be published and those whose slug is already taken, either by a
+            published sibling or an earlier page in the list. Existing
+            siblings for all of the rows are found with one query.
+        """
+        if not pages:
+            return [], []
+        parent_ids = set(parent_id for pk, parent_id, slug in pages)
+        siblings = Page.objects.filter(
+            is_published=True, slug__in=set(slug for pk, parent_id, slug in pages)
+        ).exclude(pk__in=[pk for pk, parent_id, slug in pages])
+        if None in parent_ids:
+            siblings = siblings.filter(
+                Q(parent__in=parent_ids - set([None])) | Q(parent=None))
+        else:
+            siblings = siblings.filter(parent__in=parent_ids)
+        taken = set(siblings.values_list('parent_id', 'slug'))
+
+        publish_pks, conflict_pks = [], []
+        for pk, parent_id, slug in pages:
+            if (parent_id, slug) in taken:
+                conflict_pks.append(pk)
+            else:
+                taken.add((parent_id, slug))
+                publish_pks.append(pk)
+        return publish_pks, conflict_pks
+
+    def update_paths_of_pages(self, page_pks):
+        """ Updates the paths of many pages. A page below another one in
+            the list is covered by the update of that page's subtree.
+        """
+        changed_paths = set()
+        covered = None
+        pages = Page.objects.filter(pk__in=page_pks).order_by('tree_id', 'lft')
+        for page in pages:
+            # In tree order a page is either inside the last subtree that
+            # was updated or outside all of them
+            if covered and covered.tree_id == page.tree_id and \
+                    page.rght < covered.rght:
+                continue
+            covered = page
+            changed_paths.update(self.update_page_paths(page))
+        return changed_paths
+
+    def get_next_scheduled_transition(self):
+        """ Returns the earliest publish or unpublish time still to come,
+            or None if nothing is scheduled.
+        """
+        times = Page.objects.aggregate(
+            next_publish=Min('publish_at'), next_unpublish=Min('unpublish_at'))
+        times = [time for time in times.values() if time is not None]
+        return min(times) if times else None
+
+    def get_page_validator(self, page):
+        """ Returns an (etag, last modified) pair for a page, worked out with
+            one aggregate query over the page, its template, regions and
+            block links. Block saves touch their links, so they count too.
+        """
+        stamps = Page.objects.filter(pk=page.pk).aggregate(
+            page_modified=Max('modified'),
+            template_modified=Max('page_template__modified'),
+            region_modified=Max('page_template__region__modified'),
+            link_modified=Max('contentblocklink__modified'),
+            region_count=Count('page_template__region', distinct=True),
+            link_count=Count('contentblocklink', distinct=True))
+        last_modified = max(
+            stamps[name] for name in ('page_modified', 'template_modified',
+                                      'region_modified', 'link_modified')
+            if stamps[name] is not None)
+        # The counts catch regions and links that have been deleted
+        etag = hashlib.md5('%s:%s:%s:%s' % (
+            page.pk, last_modified.isoformat(),
+            stamps['region_count'], stamps['link_count'])).hexdigest()
+        return etag, last_modified
+
+    def get_page_path(self, page):
+        """ Returns the full slug path of a page, or None if the page can not
+            be served because it or one of its ancestors is not published.
+        """
+        if page.is_deleted or not page.is_published:
+            return None
+        if page.parent_id is None:
+            return page.slug
+        parent_path = Page.objects.values_list('path', flat=True).get(
+            pk=page.parent_id)
+        if parent_path is None:
+            return None
+        return parent_path + '/' + page.slug
+
+    @transaction.atomic
+    def update_page_paths(self, page):
+        """ Rewrites the stored path of a page and of every page below it.
+            The subtree is read and cleared using its MPTT lft/rght range.
+            Returns the old and new paths of the page and of any page in the
+            subtree whose path changed.
+        """
+        # Moving a page changes its tree fields, so make sure they are fresh
+        page = self.get_page_by_pk(page.pk)
+        subtree = Page.objects.filter(tree_id=page.tree_id,
+                                      lft__gte=page.lft,
+                                      rght__lte=page.rght)
+        old_paths = dict(subtree.exclude(path=None).values_list('pk', 'path'))
+        new_paths = {}
+        page_path = self.get_page_path(page)
+        if page_path is not None:
+            new_paths[page.pk] = page_path
+            descendants = subtree.filter(
+                lft__gt=page.lft, is_deleted=False, is_published=True
+            ).order_by('lft').values_list('pk', 'parent_id', 'slug')
+            for pk, parent_id, slug in descendants:
+                # Parents come before children, so an unreachable parent
+                # makes the whole branch unreachable
+                if parent_id in new_paths:
+                    new_paths[pk] = new_paths[parent_id] + '/' + slug
+
+        # Clear the old paths first so moves can not trip the unique index
+        subtree.exclude(path=None).update(path=None)
+        bulk_update_field(Page, 'path', new_paths)
+
+        changed_paths = set([old_paths.get(page.pk), page_path])
+        for pk in set(old_paths) | set(new_paths):
+            if old_paths.get(pk) != new_paths.get(pk):
+                changed_paths.update([old_paths.get(pk), new_paths.get(pk)])
+        changed_paths.discard(None)
+        return changed_paths
+
+    @transaction.atomic
+    def rebuild_page_paths(self):
+        """ Recalculates the path of every page from scratch. Paths claimed
+            by more than one published page are left empty, along with
+            everything below them, and returned.
+        """
+        pages = Page.objects.filter(
+            is_deleted=False, is_published=True
+        ).order_by('tree_id', 'lft').values_list('pk', 'parent_id', 'slug')
+
+        page_paths = {}
+        pks_by_path = {}
+        for pk, parent_id, slug in pages.iterator():
+            if parent_id is None:
+                path = slug
+            elif parent_id in page_paths:
+                path = page_paths[parent_id] + '/' + slug
+            else:
+                continue
+            page_paths[pk] = path
+            pks_by_path.setdefault(path, []).append(pk)
+
+        conflicts = set(
+            path for path, pks in pks_by_path.iteritems() if len(pks) > 1)
+        new_paths = dict(
+            (pk, path) for pk, path in page_paths.iteritems()
+            if not self.has_conflicting_path(path, conflicts))
+
+        Page.objects.exclude(path=None).update(path=None)
+        bulk_update_field(Page, 'path', new_paths)
+        page_route_index.invalidate()
+        return sorted(conflicts)
+
+    @transaction.atomic
+    def rebuild_page_tree(self, tree_ids=None, moved_pks=()):
+        """ Recalculates the MPTT fields of every page from the parent links
+            in a single pass, keeping the current order of siblings. Unlike
+            the MPTT rebuild this reads the tree with one query.
+
+            Pass tree_ids to only rebuild the pages currently in those trees.
+            Pages in moved_pks are placed after their new siblings.
+        """
+        pages = Page.objects.order_by('tree_id', 'lft', 'pk').values_list(
+            'pk', 'parent_id', 'tree_id')
+        if tree_ids is not None:
+            pages = pages.filter(tree_id__in=tree_ids)
+            next_tree_id = (Page.objects.aggregate(
+                max_tree_id=Max('tree_id'))['max_tree_id'] or 0) + 1
+        roots = []
+        child_pks = {}
+        for pk, parent_id, tree_id in pages.iterator():
+            if parent_id is None:
+                roots.append((pk, tree_id))
+            else:
+                child_pks.setdefault(parent_id, []).append(pk)
+
+        if tree_ids is None:
+            roots = [(root_pk, tree_id)
+                     for tree_id, (root_pk, old_tree_id) in enumerate(roots, 1)]
+        else:
+            # Pages moved to the top level still share the tree of their old
+            # root, which comes first, so they are given trees of their own
+            used_tree_ids = set()
+            for index, (root_pk, tree_id) in enumerate(roots):
+                if tree_id in used_tree_ids:
+                    roots[index] = (root_pk, next_tree_id)
+                    next_tree_id += 1
+                used_tree_ids.add(roots[index][1])
+        if moved_pks:
+            moved_pks = set(moved_pks)
+            for children in child_pks.itervalues():
+                children.sort(key=lambda pk: pk in moved_pks)
+
+        tree_fields = {}
+        for root_pk, tree_id in roots:
+            counter = 1
+            # Walk the tree depth first. Each page is seen twice, once on the
+            # way down to set its left value and again on the way back up.
+            stack = [(root_pk, 0, False)]
+            while stack:
+                pk, level, visited = stack.pop()
+                if visited:
+                    tree_fields[pk] = (tree_id, tree_fields[pk], counter, level)
+                    counter += 1
+                    continue
+                tree_fields[pk] = counter
+                counter += 1
+                stack.append((pk, level, True))
+                for child_pk in reversed(child_pks.get(pk, [])):
+                    stack.append((child_pk, level + 1, False))
+
+        opts = Page._mptt_meta
+        bulk_update_fields(Page, [opts.tree_id_attr, opts.left_attr,
+                                  opts.right_attr, opts.level_attr],
+                           tree_fields)
+
+    def has_conflicting_path(self, path, conflicts):
+        """ Checks the path and each of its ancestor paths for conflicts """
+        parts = path.split('/')
+        for depth in range(1, len(parts) + 1):
+            if '/'.join(parts[:depth]) in conflicts:
+                return True
+        return False
+
     def get_page_by_pk(self, page_pk):
         return Page.objects.get(pk=page_pk)
 
@@ -173,6 +627,7 @@ class RegionService(object):
     def create_region(self, name, block_name, template, **extra_fields):
         Region.objects.create(
             name=name, block_name=block_name, template=template, **extra_fields)
+        page_cache.invalidate_pages(Page.objects.filter(page_template=template))
 
     def get_regions_for_page(self, page):
         return page.page_template.region_set.all()
@@ -180,22 +635,13 @@ class RegionService(object):
 
 class ContentBlockService(object):
     def get_allowed_content_blocks(self):
-        app_config = apps.get_app_config(CMS_APP.split('.')[-1])
-        content_block_classes = []
-        for model_class in app_config.get_models():
-            if issubclass(model_class, BaseContentBlock):
-                class_name = model_class._meta.verbose_name.title()
-                content_type = ContentType.objects.get_for_model(model_class)
-                content_block_classes.append((class_name, content_type.pk))
-        return content_block_classes
+        return content_block_registry.get_choices()
 
     def get_model_content_type(self, model):
         return ContentType.objects.get_for_model(model).pk
 
     def get_contentblock_model(self, content_type):
-        content_type = ContentType.objects.get(pk=content_type)
-        model_class = content_type.model_class()
-        return model_class
+        return content_block_registry.get_model(content_type)
 
     def get_contentblock_by_pk(self, pk, model_class):
         return model_class.objects.get(pk=pk)
@@ -204,54 +650,150 @@ class ContentBlockService(object):
         """ This takes a model form and creates the block object.
             This is not done explicitly because the forms are dynamic.
         """
-        block_instance = form.save()
+        old_partial = form.initial.get('partial')
+        block_instance = form.save(commit=False)
+        with transaction.atomic():
+            if block_instance.pk is None:
+                block_instance.save()
+            else:
+                self.save_new_block_version(block_instance)
+            form.save_m2m()
+        template_cache.invalidate(getattr(old_partial, 'name', None),
+                                  block_instance.partial.name)
+        # The post_save handler cleared them too, but a request may have
+        # cached the old content again before the save was committed
+        page_cache.invalidate_pages(self.get_pages_for_block(block_instance))
         return block_instance
 
+    def save_new_block_version(self, block):
+        """ Saves a block without writing its version, so it can not undo a
+            concurrent save. The post_save handler then moves it on to a new
+            version, which leaves any cached fragments behind.
+        """
+        block.save(update_fields=[
+            field.name for field in block._meta.concrete_fields
+            if not field.primary_key and field.name != 'version'])
+
+    def get_block_links(self, block):
+        return ContentBlockLink.objects.filter(
+            object_id=block.pk,
+            content_type=ContentType.objects.get_for_model(block))
+
+    def get_pages_for_block(self, block):
+        block_links = self.get_block_links(block)
+        return Page.objects.filter(pk__in=block_links.values('page'))
+
     def link_block(self, block, page_pk, region_pk, block_content_type):
         content_type = ContentType.objects.get(pk=block_content_type)
         page = Page.objects.get(pk=page_pk)
         region = Region.objects.get(pk=region_pk)
+        last_position = ContentBlockLink.objects.filter(
+            page=page, region=region).aggregate(
+            last_position=Max('position'))['last_position']
         ContentBlockLink.objects.create(page=page,
                                         region=region,
                                         object_id=block.pk,
                                         content_type=content_type,
-                                        model_object=block)
+                                        model_object=block,
+                                        position=(
+                                            0 if last_position is None
+                                            else last_position + 1))
+        page_cache.invalidate_pages(Page.objects.filter(pk=page.pk))
+
+    @transaction.atomic
+    def reorder_blocks(self, page_pk, region_pk, link_pks):
+        """ Puts the blocks of a region on a page in the order of the given
+            link pks with a single update. Links of the region left out of
+            the list keep their position after the given ones.
+        """
+        current_pks = list(ContentBlockLink.objects.filter(
+            page=page_pk, region=region_pk
+        ).order_by('position', 'pk').values_list('pk', flat=True))
+        link_pks = [int(pk) for pk in link_pks]
+        if set(link_pks) - set(current_pks):
+            raise ContentBlockLink.DoesNotExist
+        ordered_pks = link_pks + [pk for pk in current_pks if pk not in link_pks]
+
+        # Touching the links changes the page's validator
+        now = timezone.now()
+        bulk_update_fields(ContentBlockLink, ['position', 'modified'],
+                           dict((pk, (position, now))
+                                for position, pk in enumerate(ordered_pks)))
+        # The update skips the render plan signal handlers
+        Page.objects.filter(pk=page_pk).update(
+            render_plan='', render_plan_version=F('render_plan_version') + 1)
+        page_cache.invalidate_pages(Page.objects.filter(pk=page_pk))
 
     def relink_block(self, block, page_pk, region_pk, block_content_type):
         content_type = ContentType.objects.get(pk=block_content_type)
         page = Page.objects.get(pk=page_pk)
         region = Region.objects.get(pk=region_pk)
         content_block_link = ContentBlockLink.objects.get(object_id=block.pk)
+        page_cache.invalidate_pages(Page.objects.filter(pk=page.pk))
         return content_block_link
 
 
 class URLService(object):
+    """ Reverses the dashboard urls.
+
+        Each named url is only reversed once per process. Urls taking a pk
+        are reversed with a placeholder pk and later built from the parts
+        either side of it. The cache is thrown away whenever the resolver or
+        script prefix changes, such as after clear_url_caches is called.
+    """
+    # Stands in for the pk when reversing urls that take one
+    PK_PLACEHOLDER = '987654321'
+
+    _url_parts = {}
+    _url_parts_resolver = None
+
     def get_page_edit_url(self, pk):
-        default_name = 'edit-page'
-        if DASHBOARD_NAMESPACE is None:
-            return reverse_lazy(default_name, kwargs={'pk': pk})
-        return reverse_lazy(DASHBOARD_NAMESPACE + ':' + default_name,
-                            kwargs={'pk': pk})
+        return self.get_url('edit-page', pk=pk)
 
     def get_page_create_url(self):
-        default_name = 'create-page'
-        if DASHBOARD_NAMESPACE is None:
-            return reverse_lazy(default_name)
-        return reverse_lazy(DASHBOARD_NAMESPACE + ':' + default_name)
+        return self.get_url('create-page')
 
     def get_page_index_url(self):
-        default_name = 'pages-index'
-        if DASHBOARD_NAMESPACE is None:
-            return reverse_lazy(default_name)
-        return reverse_lazy(DASHBOARD_NAMESPACE + ':' + default_name)
+        return self.get_url('pages-index')
+
+    def get_page_tree_url(self):
+        return self.get_url('pages-tree')
 
     def get_page_template_index_url(self):
-        default_name = 'page-template-index'
-        if DASHBOARD_NAMESPACE is None:
-            return reverse_lazy(default_name)
-        return reverse_lazy(DASHBOARD_NAMESPACE + ':' + default_name)
+        return self.get_url('page-template-index')
+
+    def get_url(self, default_name, pk=None):
+        url_parts = self.get_url_parts(default_name, pk is not None)
+        if pk is None:
+            return url_parts[0]
+        return url_parts[0] + str(pk) + url_parts[1]
+
+    def get_url_parts(self, default_name, takes_pk):
+        resolver = (get_resolver(get_urlconf()), get_script_prefix())
+        if URLService._url_parts_resolver != resolver:
+            URLService._url_parts = {}
+            URLService._url_parts_resolver = resolver
+
+        url_parts = URLService._url_parts.get((default_name, takes_pk))
+        if url_parts is None:
+            url_parts = self.reverse_url_parts(default_name, takes_pk)
+            URLService._url_parts[default_name, takes_pk] = url_parts
+        return url_parts
+
+    def reverse_url_parts(self, default_name, takes_pk):
+        name = default_name
+        if DASHBOARD_NAMESPACE is not None:
+            name = DASHBOARD_NAMESPACE + ':' + default_name
+        if not takes_pk:
+            return (reverse(name), '')
+        url = reverse(name, kwargs={'pk': self.PK_PLACEHOLDER})
+        return tuple(url.split(self.PK_PLACEHOLDER, 1))
 
 
 # Helper exceptions
 class PageConflictingSlugException(Exception):
     pass
+
+
+class InvalidPageMoveException(Exception):
+    pass
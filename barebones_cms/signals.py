@@ -0,0 +1,68 @@
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.loading import get_model
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
+
+from barebones_cms.caching import page_cache
+from barebones_cms.registry import content_block_registry
+
+
+# Allow the cms app to be completely overridden with another namespace
+CMS_APP = getattr(settings, 'BB_CMS_APP_NAME', 'apps.cms').split('.')[-1]
+
+
+Page = get_model(CMS_APP, 'Page')
+PageTemplate = get_model(CMS_APP, 'PageTemplate')
+Region = get_model(CMS_APP, 'Region')
+ContentBlockLink = get_model(CMS_APP, 'ContentBlockLink')
+
+
+# Page validators take their last modified time from the stamps of what is
+# still there, so deleting something has to move a remaining stamp forward.
+def link_deleted(sender, instance, **kwargs):
+    Page.objects.filter(pk=instance.page_id).update(modified=timezone.now())
+
+
+def region_deleted(sender, instance, **kwargs):
+    PageTemplate.objects.filter(pk=instance.template_id).update(
+        modified=timezone.now())
+
+
+def block_deleted(sender, instance, **kwargs):
+    get_block_links(instance).update(modified=timezone.now())
+
+
+def block_saved(sender, instance, created=False, raw=False, **kwargs):
+    """ Moves a changed block on to a new version, which leaves its cached
+        fragments behind, and touches its links so the pages showing it
+        change however the block was saved. New blocks have no links yet.
+    """
+    if raw or created:
+        return
+    # Incremented in the database so concurrent saves never share a version
+    blocks = sender.objects.filter(pk=instance.pk)
+    blocks.update(version=F('version') + 1)
+    instance.version = blocks.values_list('version', flat=True).get()
+    block_links = get_block_links(instance)
+    block_links.update(modified=timezone.now())
+    page_cache.invalidate_pages(
+        Page.objects.filter(pk__in=block_links.values('page')))
+
+
+def get_block_links(block):
+    return ContentBlockLink.objects.filter(
+        content_type=ContentType.objects.get_for_model(block),
+        object_id=block.pk)
+
+
+def connect_signals():
+    """ Keeps page validators and cached pages moving on when content is
+        changed outside the services. Called when the app is ready.
+    """
+    post_delete.connect(link_deleted, sender=ContentBlockLink)
+    post_delete.connect(region_deleted, sender=Region)
+    for model in content_block_registry.get_models():
+        post_save.connect(block_saved, sender=model)
+        post_delete.connect(block_deleted, sender=model)
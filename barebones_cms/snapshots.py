@@ -0,0 +1,157 @@
+import hashlib
+import json
+
+from django.conf import settings
+from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Max
+from django.db.models.loading import get_model
+from django.utils import timezone
+
+from barebones_cms.caching import page_cache
+from barebones_cms.services import PageService, RegionService
+
+
+# Allow the cms app to be completely overridden with another namespace
+CMS_APP = getattr(settings, 'BB_CMS_APP_NAME', 'apps.cms').split('.')[-1]
+# Serve pages from their live snapshot rather than their current content.
+# Needs a PageSnapshot model in the cms app.
+SERVE_SNAPSHOTS = getattr(settings, 'BB_CMS_SERVE_SNAPSHOTS', False)
+# Bumped whenever the layout of the snapshot content changes
+SNAPSHOT_FORMAT = 1
+
+
+Page = get_model(CMS_APP, 'Page')
+try:
+    PageSnapshot = get_model(CMS_APP, 'PageSnapshot')
+except LookupError:
+    # Snapshots are optional, so the cms app does not have to define it
+    PageSnapshot = None
+
+
+class LivePage(object):
+    """ The content of a page rebuilt from a snapshot without touching the
+        database. Objects are unsaved copies of the ones that were published.
+    """
+    def __init__(self, snapshot, page, regions, region_blocks):
+        self.snapshot = snapshot
+        self.page = page
+        self.regions = regions
+        self.region_blocks = region_blocks
+
+    def get_validator(self):
+        """ Snapshots never change, so the etag only depends on which one
+            is live. The last modified time is when it went live, which
+            moves forward on a rollback even though the snapshot is older.
+        """
+        etag = hashlib.md5('snapshot:%s:%s' % (
+            self.snapshot.page_id, self.snapshot.pk)).hexdigest()
+        return etag, self.snapshot.live_since or self.snapshot.created
+
+
+class PageSnapshotService(object):
+    def is_enabled(self):
+        return SERVE_SNAPSHOTS and PageSnapshot is not None
+
+    def publish_page(self, page_pk):
+        """ Snapshots the current content of a page and makes it live.
+            Returns the new snapshot.
+        """
+        with transaction.atomic():
+            page = Page.objects.select_related('page_template').get(pk=page_pk)
+            version = PageSnapshot.objects.filter(page=page).aggregate(
+                latest=Max('version'))['latest'] or 0
+            PageSnapshot.objects.filter(page=page, is_live=True).update(is_live=False)
+            snapshot = PageSnapshot.objects.create(
+                page=page, version=version + 1, is_live=True,
+                live_since=timezone.now(), content=self.serialize_page(page))
+        # Once committed, so the page is not cached again from the old snapshot
+        page_cache.invalidate_paths([page.path])
+        return snapshot
+
+    def rollback_page(self, page_pk, version):
+        """ Makes an earlier snapshot of a page live again """
+        with transaction.atomic():
+            snapshot = PageSnapshot.objects.get(page=page_pk, version=version)
+            PageSnapshot.objects.filter(page=page_pk, is_live=True).update(is_live=False)
+            snapshot.is_live = True
+            snapshot.live_since = timezone.now()
+            PageSnapshot.objects.filter(pk=snapshot.pk).update(
+                is_live=True, live_since=snapshot.live_since)
+        page_cache.invalidate_paths(
+            Page.objects.filter(pk=page_pk).values_list('path', flat=True))
+        return snapshot
+
+    def get_snapshots(self, page_pk):
+        return PageSnapshot.objects.filter(page=page_pk).defer(
+            'content').order_by('-version')
+
+    def serialize_page(self, page):
+        regions = list(RegionService().get_regions_for_page(page))
+        region_blocks = PageService().get_content_blocks_for_page(page)
+        blocks = []
+        block_order = []
+        for region in regions:
+            indexes = []
+            for block in region_blocks.get(region.pk, []):
+                indexes.append(len(blocks))
+                blocks.append(block)
+            block_order.append(indexes)
+
+        content = {
+            'format': SNAPSHOT_FORMAT,
+            'page': self.serialize(
+                [page], exclude=['render_plan', 'render_plan_version'])[0],
+            'page_template': self.serialize([page.page_template])[0],
+            'regions': self.serialize(regions),
+            'blocks': self.serialize(blocks),
+            # The blocks of each region, by index into the blocks
+            'block_order': block_order,
+        }
+        return json.dumps(content, cls=DjangoJSONEncoder, separators=(',', ':'))
+
+    def serialize(self, objects, exclude=()):
+        fields = None
+        if exclude and objects:
+            fields = [field.name for field in objects[0]._meta.local_fields
+                      if field.name not in exclude]
+        return serializers.serialize('python', objects, fields=fields)
+
+    def deserialize(self, data):
+        return [deserialized.object for deserialized
+                in serializers.deserialize('python', data)]
+
+    def get_live_page(self, page):
+        """ Returns the live content of a page as a LivePage, or None if the
+            page has never been published
+        """
+        try:
+            snapshot = PageSnapshot.objects.get(page=page.pk, is_live=True)
+        except PageSnapshot.DoesNotExist:
+            return None
+        return self.load_snapshot(snapshot)
+
+    def load_snapshot(self, snapshot):
+        content = json.loads(snapshot.content)
+        if content['format'] != SNAPSHOT_FORMAT:
+            raise SnapshotFormatException(
+                "Snapshot %s uses format %s" % (snapshot.pk, content['format']))
+
+        page = self.deserialize([content['page']])[0]
+        page_template = self.deserialize([content['page_template']])[0]
+        # Save the page template lookup a query
+        page_template_field = Page._meta.get_field('page_template')
+        setattr(page, page_template_field.get_cache_name(), page_template)
+
+        regions = self.deserialize(content['regions'])
+        blocks = self.deserialize(content['blocks'])
+        region_blocks = {}
+        for region, indexes in zip(regions, content['block_order']):
+            region_blocks[region.pk] = [blocks[index] for index in indexes]
+        return LivePage(snapshot, page, regions, region_blocks)
+
+
+# Helper exceptions
+class SnapshotFormatException(Exception):
+    pass
@@ -0,0 +1,184 @@
+import errno
+import json
+import multiprocessing
+import os
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.db import connections
+from django.db.models.loading import get_model
+from django.test.client import RequestFactory
+
+from barebones_cms.views import ServeCMSPageView
+
+
+# Allow the cms app to be completely overridden with another namespace
+CMS_APP = getattr(settings, 'BB_CMS_APP_NAME', 'apps.cms').split('.')[-1]
+# Kept in the output directory. Maps each exported path to the ETag of the
+# page when it was rendered so later exports can skip unchanged pages.
+MANIFEST_NAME = '.bb_cms_manifest.json'
+MANIFEST_FORMAT = 1
+
+RENDERED = 'rendered'
+UNCHANGED = 'unchanged'
+MISSING = 'missing'
+
+
+Page = get_model(CMS_APP, 'Page')
+
+# The exporter used by each worker process, set up by init_worker
+_worker_exporter = None
+
+
+def init_worker(exporter):
+    """ Runs in each new worker process. The connections inherited from the
+        parent were closed before the pool started, so each worker opens
+        its own the first time it queries.
+    """
+    global _worker_exporter
+    _worker_exporter = exporter
+
+
+def export_path_in_worker(path_and_etag):
+    return _worker_exporter.export_path(*path_and_etag)
+
+
+class StaticSiteExporter(object):
+    """ Renders every published page to <output_dir>/<path>/index.html so
+        a web server can serve the site without Django.
+
+        Pages are rendered on a pool of processes by calling the serving
+        view with a fake GET request, so output is exactly what visitors
+        get. In incremental mode the ETag saved for each path in the
+        manifest is sent as If-None-Match and pages the view answers with a
+        304 are left alone. Files of pages that are no longer published are
+        removed either way.
+    """
+    view_class = ServeCMSPageView
+
+    def __init__(self, output_dir, workers=None, incremental=False):
+        self.output_dir = output_dir
+        self.workers = workers or multiprocessing.cpu_count()
+        self.incremental = incremental
+
+    def export(self):
+        """ Exports the site and returns a dict of the number of pages with
+            each outcome, plus the number of files removed
+        """
+        old_manifest = self.load_manifest()
+        paths = list(Page.objects.exclude(path=None).order_by(
+            'tree_id', 'lft').values_list('path', flat=True))
+        jobs = [(path, old_manifest.get(path) if self.incremental else None)
+                for path in paths]
+
+        # Forked workers must not share the parent's database connections
+        for connection in connections.all():
+            connection.close()
+        pool = multiprocessing.Pool(self.workers, init_worker, (self,))
+        try:
+            results = pool.map(export_path_in_worker, jobs,
+                               self.get_chunk_size(len(jobs)))
+        finally:
+            pool.terminate()
+            pool.join()
+
+        counts = {RENDERED: 0, UNCHANGED: 0, MISSING: 0}
+        manifest = {}
+        for path, outcome, etag in results:
+            counts[outcome] += 1
+            if outcome != MISSING:
+                manifest[path] = etag
+        counts['removed'] = self.remove_paths(set(old_manifest) - set(manifest))
+        self.save_manifest(manifest)
+        return counts
+
+    def get_chunk_size(self, count):
+        # A few chunks per worker keeps them all busy until the end
+        return max(1, count // (self.workers * 4))
+
+    def export_path(self, path, etag=None):
+        """ Renders one page and writes it out unless it is unchanged.
+            Returns the path, the outcome and the ETag of the page.
+        """
+        if etag and not os.path.exists(self.get_file_path(path)):
+            # Render it again if the file has gone
+            etag = None
+        response = self.get_response(path, etag)
+        if response.status_code == 304:
+            return path, UNCHANGED, etag
+        if response.status_code != 200:
+            return path, MISSING, None
+
+        if response.streaming:
+            content = b''.join(response.streaming_content)
+        else:
+            content = response.content
+        self.write_file(self.get_file_path(path), content)
+        return path, RENDERED, response['ETag']
+
+    def get_response(self, path, etag=None):
+        headers = {}
+        if etag:
+            headers['HTTP_IF_NONE_MATCH'] = etag
+        request = RequestFactory().get('/%s/' % path, **headers)
+        # Exported pages are the ones anonymous visitors see
+        request.user = AnonymousUser()
+        return self.view_class.as_view(record_hits=False)(request)
+
+    def get_file_path(self, path):
+        return os.path.join(self.output_dir, *(path.split('/') + ['index.html']))
+
+    def write_file(self, file_path, content):
+        """ Writes a file through a temporary file and a rename, so the web
+            server never sees half a page
+        """
+        directory = os.path.dirname(file_path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        temporary_path = '%s.%s.tmp' % (file_path, os.getpid())
+        with open(temporary_path, 'wb') as output:
+            output.write(content)
+        os.rename(temporary_path, file_path)
+
+    def remove_paths(self, paths):
+        """ Deletes the files of pages that are no longer exported, and their
+            directories once empty. Returns the number of files removed.
+        """
+        removed = 0
+        # Deepest first, so child directories are emptied before parents
+        for path in sorted(paths, key=lambda path: -path.count('/')):
+            file_path = self.get_file_path(path)
+            try:
+                os.remove(file_path)
+                removed += 1
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            try:
+                os.rmdir(os.path.dirname(file_path))
+            except OSError:
+                # Still holds the pages below it
+                pass
+        return removed
+
+    def get_manifest_path(self):
+        return os.path.join(self.output_dir, MANIFEST_NAME)
+
+    def load_manifest(self):
+        try:
+            with open(self.get_manifest_path()) as manifest_file:
+                manifest = json.load(manifest_file)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {}
+        if manifest.get('format') != MANIFEST_FORMAT:
+            return {}
+        return manifest['pages']
+
+    def save_manifest(self, pages):
+        self.write_file(self.get_manifest_path(), json.dumps(
+            {'format': MANIFEST_FORMAT, 'pages': pages}, indent=2, sort_keys=True))
@@ -0,0 +1,106 @@
+import os
+import traceback
+from collections import OrderedDict
+
+import django
+from django.db import connection as default_connection
+from django.db.backends.utils import CursorDebugWrapper
+from django.test.utils import CaptureQueriesContext
+
+
+# Frames in these directories are skipped when finding where a query came from
+SKIPPED_PATHS = (
+    os.path.dirname(django.__file__) + os.sep,
+    os.path.splitext(__file__)[0],
+)
+# Number of distinct statements shown for each call site in a failure
+SQL_PER_CALL_SITE = 3
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def get_call_site():
+    """ The innermost frame outside Django and this module, as a
+        "file:line in function" string
+    """
+    for filename, line, function, text in reversed(traceback.extract_stack()):
+        if not filename.startswith(SKIPPED_PATHS):
+            return '%s:%s in %s' % (filename, line, function)
+    return 'unknown'
+
+
+class CallSiteCursorWrapper(CursorDebugWrapper):
+    """ A debug cursor that also records where each query was run from """
+    def __init__(self, cursor, db, call_sites):
+        super(CallSiteCursorWrapper, self).__init__(cursor, db)
+        self.call_sites = call_sites
+
+    def execute(self, sql, params=None):
+        try:
+            return super(CallSiteCursorWrapper, self).execute(sql, params)
+        finally:
+            self.record()
+
+    def executemany(self, sql, param_list):
+        try:
+            return super(CallSiteCursorWrapper, self).executemany(sql, param_list)
+        finally:
+            self.record()
+
+    def record(self):
+        self.call_sites.append((get_call_site(), self.db.queries[-1]['sql']))
+
+
+class assert_max_queries(CaptureQueriesContext):
+    """ Fails with QueryBudgetExceeded if the block runs more than
+        max_queries queries. The message lists the queries grouped by the
+        code that ran them, most frequent first, so an N+1 stands out.
+
+            with assert_max_queries(5):
+                client.get('/about/')
+
+        Only queries on the given connection in the current thread count.
+    """
+    def __init__(self, max_queries, connection=default_connection, label=None):
+        super(assert_max_queries, self).__init__(connection)
+        self.max_queries = max_queries
+        self.label = label
+        self.call_sites = []
+
+    def __enter__(self):
+        self.call_sites = []
+        call_sites = self.call_sites
+        connection = self.connection
+        connection.make_debug_cursor = lambda cursor: CallSiteCursorWrapper(
+            cursor, connection, call_sites)
+        return super(assert_max_queries, self).__enter__()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        # Removing the instance attribute brings back the normal debug cursor
+        del self.connection.make_debug_cursor
+        super(assert_max_queries, self).__exit__(exc_type, exc_value, exc_traceback)
+        if exc_type is None and len(self) > self.max_queries:
+            raise QueryBudgetExceeded(self.get_failure_message())
+
+    def get_queries_by_call_site(self):
+        """ Returns an OrderedDict of call site to the SQL it ran, with the
+            busiest call sites first
+        """
+        grouped = {}
+        for call_site, sql in self.call_sites:
+            grouped.setdefault(call_site, []).append(sql)
+        return OrderedDict(sorted(grouped.items(), key=lambda item: -len(item[1])))
+
+    def get_failure_message(self):
+        lines = ['%s%d queries run, the budget is %d' % (
+            '%s: ' % self.label if self.label else '', len(self), self.max_queries)]
+        for call_site, statements in self.get_queries_by_call_site().iteritems():
+            lines.append('  %dx %s' % (len(statements), call_site))
+            distinct = list(OrderedDict.fromkeys(statements))
+            for sql in distinct[:SQL_PER_CALL_SITE]:
+                lines.append('      %s' % sql)
+            if len(distinct) > SQL_PER_CALL_SITE:
+                lines.append('      ... and %d more' % (len(distinct) - SQL_PER_CALL_SITE))
+        return '\n'.join(lines)
@@ -0,0 +1,62 @@
+import shutil
+import tempfile
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from barebones_cms.benchmark.budgets import get_query_budgets
+from barebones_cms.benchmark.generator import Page, SiteGenerator, SiteShape
+from barebones_cms.services import PageService, URLService
+from barebones_cms.testing import assert_max_queries
+
+
+class QueryBudgetTestCase(TestCase):
+    """ Serving, resolving and editing pages must stay within the budgets
+        used by cms_benchmark --check-budgets. They are checked against a
+        small and a much larger site, as none of them should grow with the
+        number of pages, regions or blocks.
+    """
+    def setUp(self):
+        # Keep the generated templates out of the project's media
+        self.media_root = tempfile.mkdtemp(prefix='bb_cms_tests_')
+        self.media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        self.media_settings.enable()
+
+    def tearDown(self):
+        self.media_settings.disable()
+        shutil.rmtree(self.media_root)
+
+    def check_budgets(self, shape):
+        SiteGenerator(shape).generate()
+        budgets = get_query_budgets(shape)
+        # The deepest page has the most ancestors to trip over
+        page = Page.objects.exclude(path=None).order_by('-level', '-pk')[0]
+        path = '/%s/' % page.path
+        url_service = URLService()
+
+        with assert_max_queries(budgets['get_page_from_path'],
+                                label='get_page_from_path'):
+            self.assertEqual(PageService().get_page_from_path(path), page)
+        for name, url in (
+                ('serve_page', path),
+                ('dashboard_pages', url_service.get_page_index_url()),
+                ('dashboard_page_edit', url_service.get_page_edit_url(page.pk))):
+            # Only the first request loads the templates and content types
+            self.get(url)
+            with assert_max_queries(budgets[name], label=name):
+                self.get(url)
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        if response.streaming:
+            b''.join(response.streaming_content)
+        return response
+
+    def test_small_site(self):
+        self.check_budgets(SiteShape(depth=2, fanout=2, regions_per_template=1,
+                                     blocks_per_region=1))
+
+    def test_large_site(self):
+        self.check_budgets(SiteShape(roots=2, depth=4, fanout=4, templates=2,
+                                     regions_per_template=3, blocks_per_region=4))
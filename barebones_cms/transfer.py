@@ -0,0 +1,188 @@
+import json
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.color import no_style
+from django.core.serializers import base
+from django.core.serializers import python as python_serializer
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.loading import get_model
+from django.utils.encoding import smart_text
+
+from barebones_cms.caching import page_cache
+from barebones_cms.loading import template_cache
+from barebones_cms.plans import RenderPlanService
+from barebones_cms.registry import content_block_registry
+from barebones_cms.routing import page_route_index
+from barebones_cms.services import PageService
+
+
+# Allow the cms app to be completely overridden with another namespace
+CMS_APP = getattr(settings, 'BB_CMS_APP_NAME', 'apps.cms').split('.')[-1]
+# Number of rows read or inserted at a time. Bounds the memory used by an
+# export or import however large the site is.
+TRANSFER_BATCH_SIZE = getattr(settings, 'BB_CMS_TRANSFER_BATCH_SIZE', 1000)
+
+
+Page = get_model(CMS_APP, 'Page')
+PageTemplate = get_model(CMS_APP, 'PageTemplate')
+Region = get_model(CMS_APP, 'Region')
+ContentBlockLink = get_model(CMS_APP, 'ContentBlockLink')
+
+
+class Serializer(python_serializer.Serializer):
+    """ The python serializer, except content types are written as natural
+        keys from the content type cache rather than loaded once per row,
+        and deferred fields are left out rather than loaded one at a time.
+    """
+    def handle_field(self, obj, field):
+        if field.attname in obj.__dict__:
+            super(Serializer, self).handle_field(obj, field)
+
+    def get_dump_object(self, obj):
+        data = super(Serializer, self).get_dump_object(obj)
+        # Deferred instances belong to a generated subclass
+        data['model'] = smart_text(obj._meta.concrete_model._meta)
+        return data
+
+    def handle_fk_field(self, obj, field):
+        if field.rel.to is ContentType:
+            content_type_id = getattr(obj, field.get_attname())
+            self._current[field.name] = ContentType.objects.get_for_id(
+                content_type_id).natural_key()
+        else:
+            super(Serializer, self).handle_fk_field(obj, field)
+
+
+class SiteTransferService(object):
+    """ Exports every CMS object to JSON Lines, one object per line, and
+        imports such a file back into an empty CMS.
+
+        Objects are written in the order they have to be created in, with
+        pages in tree order so parents always come before their children.
+        The export reads each table a batch at a time, carrying on after the
+        last row of the previous batch, and the import inserts rows in
+        batches and rebuilds the page tree and paths once at the end. So
+        neither side holds the whole site in memory or touches the tree
+        once per page.
+    """
+    def get_export_querysets(self):
+        """ Returns (queryset, unique ordering) pairs in import order """
+        querysets = [
+            (PageTemplate.objects.all(), ('pk',)),
+            (Region.objects.all(), ('pk',)),
+            # Render plans are rebuilt by the import
+            (Page.objects.defer('render_plan'), ('tree_id', 'lft')),
+        ]
+        querysets.extend((model.objects.all(), ('pk',))
+                         for model in self.get_block_models())
+        querysets.append((ContentBlockLink.objects.all(), ('pk',)))
+        return querysets
+
+    def get_block_models(self):
+        """ Every registered block model plus any other model that pages
+            link to, so links never point at blocks left out of the export.
+        """
+        models = list(content_block_registry.get_models())
+        content_type_ids = ContentBlockLink.objects.values_list(
+            'content_type', flat=True).distinct()
+        for content_type_id in content_type_ids:
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            if model is not None and model not in models:
+                models.append(model)
+        return models
+
+    def export_site(self, stream):
+        """ Writes the site to a stream and returns the number of objects """
+        count = 0
+        for queryset, ordering in self.get_export_querysets():
+            for batch in self.iter_batches(queryset, ordering):
+                for data in Serializer().serialize(batch):
+                    stream.write(json.dumps(data, cls=DjangoJSONEncoder))
+                    stream.write('\n')
+                    count += 1
+        return count
+
+    def iter_batches(self, queryset, ordering):
+        """ Yields lists of objects in order, each read with its own query.
+            Database drivers buffer whole result sets, even for iterator(),
+            so a single query would hold the whole table in memory.
+        """
+        queryset = queryset.order_by(*ordering)
+        batch = list(queryset[:TRANSFER_BATCH_SIZE])
+        while batch:
+            yield batch
+            if len(batch) < TRANSFER_BATCH_SIZE:
+                return
+            last = [getattr(batch[-1], field) for field in ordering]
+            batch = list(queryset.filter(
+                self.get_after_q(ordering, last))[:TRANSFER_BATCH_SIZE])
+
+    def get_after_q(self, ordering, values):
+        """ Matches the rows that come after the given values of the
+            ordering fields
+        """
+        field, value = ordering[-1], values[-1]
+        after_q = Q(**{'%s__gt' % field: value})
+        for field, value in zip(ordering[-2::-1], values[-2::-1]):
+            after_q = Q(**{'%s__gt' % field: value}) | (Q(**{field: value}) & after_q)
+        return after_q
+
+    @transaction.atomic
+    def import_site(self, stream):
+        """ Loads an export into the database. Returns the number of objects
+            and any paths used by more than one published page. The CMS
+            tables should be empty, as objects keep their exported keys.
+        """
+        count = 0
+        models = []
+        pending = []
+        for obj in self.iter_deserialized(stream):
+            model = obj.__class__
+            if pending and (model is not pending[0].__class__ or
+                            len(pending) >= TRANSFER_BATCH_SIZE):
+                self.insert(pending)
+                pending = []
+            if model not in models:
+                models.append(model)
+            pending.append(obj)
+            count += 1
+        if pending:
+            self.insert(pending)
+
+        self.reset_sequences(models)
+        page_service = PageService()
+        page_service.rebuild_page_tree()
+        conflicts = page_service.rebuild_page_paths()
+        # Plans refer to content types by pk, which differ between databases
+        RenderPlanService().clear_plans(Page.objects.all())
+
+        template_cache.clear()
+        page_route_index.invalidate()
+        page_cache.invalidate_pages(Page.objects.all())
+        return count, conflicts
+
+    def iter_deserialized(self, stream):
+        objects = (json.loads(line) for line in stream if line.strip())
+        try:
+            for deserialized in python_serializer.Deserializer(objects):
+                if deserialized.m2m_data:
+                    raise base.DeserializationError(
+                        "Many to many fields are not supported: %s"
+                        % deserialized.object._meta)
+                yield deserialized.object
+        except ValueError as e:
+            raise base.DeserializationError(e)
+
+    def insert(self, objects):
+        objects[0].__class__.objects.bulk_create(objects)
+
+    def reset_sequences(self, models):
+        """ Makes sure new objects do not reuse the imported primary keys """
+        statements = connection.ops.sequence_reset_sql(no_style(), models)
+        if statements:
+            cursor = connection.cursor()
+            for sql in statements:
+                cursor.execute(sql)
@@ -7,13 +7,18 @@ from barebones_cms import views
 
 urlpatterns = patterns('',
     url('^dashboard/cms/pages/$', views.DashboardPagesView.as_view(), name="pages-index"),
+    url('^dashboard/cms/pages/tree/$', views.DashboardPageTreeView.as_view(), name="pages-tree"),
     url('^dashboard/cms/pages/create/', views.DashboardPageCreateView.as_view(), name="create-page"),
     url('^dashboard/cms/pages/edit/(?P<pk>\d+)/', views.DashboardPageEditView.as_view(), name="edit-page"),
+    url('^dashboard/cms/pages/publish/(?P<pk>\d+)/$', views.DashboardPagePublishView.as_view(), name="publish-page"),
+    url('^dashboard/cms/pages/rollback/(?P<pk>\d+)/(?P<version>\d+)/$', views.DashboardPageRollbackView.as_view(), name="rollback-page"),
     url('^dashboard/cms/page-template/$', views.DashboardPageTemplateIndexView.as_view(), name="page-template-index"),
     url('^dashboard/cms/page-template/create/', views.DashboardPageTemplateCreateView.as_view(), name="create-page-template"),
     url('^dashboard/cms/page-template/edit/(?P<pk>\d+)/$', views.DashboardPageTemplateEditView.as_view(), name="edit-page-template"),
     url('^dashboard/cms/template-region/create/(?P<page>\d+)/(?P<template>\d+)/$', views.DashboardTemplateRegionCreateView.as_view(), name="create-template-region-for-page"),
     url('^dashboard/cms/content-block/create/(?P<page>\d+)/(?P<region>\d+)/(?P<content_type>\d+)/', views.DashboardContentBlockCreateView.as_view(), name="create-content-block"),
+    url('^dashboard/cms/content-block/reorder/(?P<page>\d+)/(?P<region>\d+)/$', views.DashboardContentBlockReorderView.as_view(), name="reorder-content-blocks"),
     url('^dashboard/cms/content-block/edit/(?P<pk>\d+)/(?P<page>\d+)/(?P<region>\d+)/(?P<content_type>\d+)/', views.DashboardContentBlockEditView.as_view(), name="edit-content-block"),
+    url('^dashboard/cms/metrics/$', views.MetricsView.as_view(), name="cms-metrics"),
     url(r'^((?:[\w\-]+/)*)$', views.ServeCMSPageView.as_view()),
 )
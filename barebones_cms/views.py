@@ -1,32 +1,160 @@
-from django.views.generic import View, TemplateView, FormView, UpdateView
-from django.http import Http404, HttpResponseRedirect
-from django.shortcuts import render
-from django.template import loader, Context
+import calendar
 
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.views.generic import View, TemplateView, FormView, UpdateView
+from django.http import (
+    Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotModified,
+    HttpResponseRedirect, JsonResponse, StreamingHttpResponse)
+from django.utils.encoding import force_text
+from django.utils.html import conditional_escape
+from django.utils.http import (
+    http_date, parse_etags, parse_http_date_safe, quote_etag)
+
+from barebones_cms import instrumentation
+from barebones_cms.caching import page_cache, page_hits
+from barebones_cms.instrumentation import metrics, stage
+from barebones_cms.rendering import (
+    PageRenderer, ConcurrentPageRenderer, PlanPageRenderer,
+    SnapshotPageRenderer)
+from barebones_cms.plans import RenderPlanService
 from barebones_cms.services import (
     PageService, RegionService, ContentBlockService, URLService)
+from barebones_cms.snapshots import PageSnapshotService
 from barebones_cms import forms
 
 
+# Only render the root pages on the pages index and load the rest of the
+# tree from the page tree API as it is expanded
+DASHBOARD_LAZY_TREE = getattr(settings, 'BB_CMS_DASHBOARD_LAZY_TREE', False)
+# Default and largest number of pages returned by the page tree API
+PAGE_TREE_LIMIT = 100
+PAGE_TREE_MAX_LIMIT = 500
+
+
 class ServeCMSPageView(View):
+    renderer_class = PageRenderer
+    snapshot_renderer_class = SnapshotPageRenderer
+    plan_renderer_class = PlanPageRenderer
+    # Turned off by requests made by the CMS itself, such as cache warming
+    record_hits = True
+
     def dispatch(self, request, *args, **kwargs):
+        use_cache = page_cache.is_cacheable_request(request)
+        if use_cache:
+            with stage('cache'):
+                response = page_cache.get_response(request.path)
+            if response is not None:
+                self.record_hit(request)
+                return self.get_conditional_response(request, response)
+
         service = PageService()
-        page = service.get_page_from_path(request.path)
+        with stage('resolve'):
+            page = service.get_page_from_path(request.path)
+            live_page = self.get_live_page(page) if page else None
         if not page:
             raise Http404
+        instrumentation.annotate(page=page.pk)
+        self.record_hit(request)
 
-        context = {'page': page}
-        for region in RegionService().get_regions_for_page(page):
-            content_blocks = service.get_content_blocks_for_region(region, page)
-            rendered_blocks = []
-            for block in content_blocks:
-                block_template = loader.get_template(block.partial.path)
-                block_context = {'content_block': block}
-                block_context.update(context)
-                rendered_blocks.append(block_template.render(Context(block_context)))
-            context[region.block_name] = {'content_blocks': rendered_blocks}
-
-        return render(request, page.page_template.template_file.path, context)
+        # Answer conditional requests before any template is rendered
+        with stage('validate'):
+            if live_page is not None:
+                etag, last_modified = live_page.get_validator()
+            else:
+                etag, last_modified = service.get_page_validator(page)
+        response = HttpResponseNotModified()
+        self.set_validator_headers(response, etag, last_modified)
+        if self.is_not_modified(request, response):
+            return response
+
+        response = self.render_page(request, page, live_page)
+        self.set_validator_headers(response, etag, last_modified)
+        if use_cache and page_cache.is_cacheable_response(response):
+            page_cache.set_response(request.path, response)
+        return response
+
+    def record_hit(self, request):
+        if self.record_hits:
+            page_hits.record(request.path)
+
+    def get_live_page(self, page):
+        """ Returns the live snapshot of a page when pages are served from
+            snapshots. Pages that have never been published through the
+            snapshot service are rendered from their current content.
+        """
+        snapshot_service = PageSnapshotService()
+        if not snapshot_service.is_enabled():
+            return None
+        return snapshot_service.get_live_page(page)
+
+    def render_page(self, request, page, live_page=None):
+        renderer = self.get_renderer(request, page, live_page)
+        if renderer.is_streamed():
+            return StreamingHttpResponse(renderer.stream())
+        return HttpResponse(renderer.render())
+
+    def get_renderer(self, request, page, live_page=None):
+        if live_page is not None:
+            return self.snapshot_renderer_class(request, live_page)
+        plan_service = RenderPlanService()
+        if plan_service.is_enabled():
+            with stage('plan'):
+                plan = plan_service.get_plan(page)
+            return self.plan_renderer_class(request, page, plan)
+        return self.renderer_class(request, page)
+
+    def set_validator_headers(self, response, etag, last_modified):
+        response['ETag'] = quote_etag(etag)
+        response['Last-Modified'] = http_date(
+            calendar.timegm(last_modified.utctimetuple()))
+
+    def get_conditional_response(self, request, response):
+        if not self.is_not_modified(request, response):
+            return response
+        not_modified = HttpResponseNotModified()
+        for header in ('ETag', 'Last-Modified'):
+            if response.has_header(header):
+                not_modified[header] = response[header]
+        return not_modified
+
+    def is_not_modified(self, request, response):
+        """ Checks the request's If-None-Match and If-Modified-Since headers
+            against the validators set on a response
+        """
+        if request.method not in ('GET', 'HEAD'):
+            return False
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and response.has_header('ETag'):
+            etags = parse_etags(if_none_match)
+            return '*' in etags or parse_etags(response['ETag'])[0] in etags
+
+        if_modified_since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE'))
+        if if_modified_since is None or not response.has_header('Last-Modified'):
+            return False
+        last_modified = parse_http_date_safe(response['Last-Modified'])
+        return last_modified is not None and last_modified <= if_modified_since
+
+
+class ConcurrentServeCMSPageView(ServeCMSPageView):
+    """ Serves pages the same way, loading their content on a thread pool """
+    renderer_class = ConcurrentPageRenderer
+
+
+class MetricsView(View):
+    """ The metrics recorded by the instrumentation middleware and the page
+        cache counters of this process, in the Prometheus text format
+    """
+    def get(self, request, *args, **kwargs):
+        page_cache_stats = page_cache.get_stats()
+        extra_counters = [
+            ('bb_cms_page_cache_total', (('outcome', outcome),),
+             page_cache_stats[name])
+            for name, outcome in (('hits', 'hit'), ('stale_hits', 'stale'),
+                                  ('misses', 'miss'))]
+        return HttpResponse(metrics.render(extra_counters),
+                            content_type='text/plain; version=0.0.4')
 
 
 class DashboardPagesView(TemplateView):
@@ -34,43 +162,104 @@ class DashboardPagesView(TemplateView):
 
     def get_context_data(self, *args, **kwargs):
         context = super(DashboardPagesView, self).get_context_data(*args, **kwargs)
-        service = PageService()
-        root_pages = service.get_all_active_root_pages()
-
-        page_tree = {}
-        for page in root_pages:
-            page_tree[page] = page.get_descendants()
-
-        context['page_tree'] = page_tree
-        context['page_tree_rendered'] = ''
-        for page in root_pages:
-            context['page_tree_rendered'] += self.get_page_render(page)
+        if DASHBOARD_LAZY_TREE:
+            context['lazy_tree'] = True
+            context['page_tree_url'] = URLService().get_page_tree_url()
+            return context
 
+        pages = PageService().get_page_tree_nodes()
+        context['page_tree_rendered'] = self.get_tree_render(pages)
         return context
 
-    def get_page_render(self, page):
-        edit_url = URLService().get_page_edit_url(page.pk)
-        page_html = '<ul>'
-        if page.is_leaf_node():
-            page_html += "<li><a href='%s'>%s</a></li>" % (
-                edit_url, page.slug)
-        else:
-            page_html += "<li><a href='%s'>%s</a></li><ul>%s</ul>" % (
-                edit_url, page.slug, self.get_tree_render(page.children.all()))
-        page_html += '</ul>'
-        return page_html
-
     def get_tree_render(self, pages):
-        page_html = ''
-        for page in pages:
-            edit_url = URLService().get_page_edit_url(page.pk)
-            if page.is_leaf_node():
-                page_html += "<li><a href='%s'>%s</a></li>" % (
-                    edit_url, page.slug)
-            else:
-                page_html = "<li><a href='%s'>%s</a></li><ul>%s</ul>" % (
-                    edit_url, page.slug, self.get_tree_render(page.children.all()))
-        return page_html
+        """ Builds the nested lists for the page tree in a single pass over
+            pages ordered by tree and left value. Each page with descendants
+            opens a list that is closed once a page past its right value is
+            reached.
+        """
+        url_service = URLService()
+        page_html = []
+        open_lists = []
+        for pk, slug, tree_id, lft, rght, level in pages:
+            while open_lists and (open_lists[-1][0] != tree_id or
+                                  open_lists[-1][1] < lft):
+                page_html.append(open_lists.pop()[2])
+
+            if level == 0:
+                # Every tree gets a list of its own
+                page_html.append('<ul>')
+            page_html.append("<li><a href='%s'>%s</a></li>" % (
+                url_service.get_page_edit_url(pk), conditional_escape(slug)))
+            closing_html = '</ul></ul>' if level == 0 else '</ul>'
+            if rght - lft > 1:
+                page_html.append('<ul>')
+                open_lists.append((tree_id, rght, closing_html))
+            elif level == 0:
+                page_html.append('</ul>')
+
+        while open_lists:
+            page_html.append(open_lists.pop()[2])
+        return ''.join(page_html)
+
+
+class DashboardPageTreeView(View):
+    """ A JSON listing of pages for the lazily expanded page tree.
+
+        Returns the children of the page given as parent, root pages when no
+        parent is given, or the pages whose slug or title starts with q. The
+        listings use keyset pagination: pass the returned next value back as
+        after to get the following pages.
+    """
+    def get(self, request, *args, **kwargs):
+        try:
+            parent = self.get_int_param('parent')
+            after = self.get_int_param('after')
+            limit = self.get_int_param('limit')
+        except ValueError:
+            return HttpResponseBadRequest()
+        if (limit is not None and limit < 1) or (after is not None and after < 0):
+            return HttpResponseBadRequest()
+        limit = min(limit or PAGE_TREE_LIMIT, PAGE_TREE_MAX_LIMIT)
+
+        service = PageService()
+        prefix = request.GET.get('q')
+        # Fetch one extra page to find out whether there is another page
+        if prefix:
+            pages = service.search_page_listing(prefix, after, limit + 1)
+            cursor_field = 'pk'
+        elif parent is not None:
+            pages = service.get_child_page_listing(parent, after, limit + 1)
+            cursor_field = 'lft'
+        else:
+            pages = service.get_root_page_listing(after, limit + 1)
+            cursor_field = 'tree_id'
+
+        next_cursor = None
+        if len(pages) > limit:
+            pages = pages[:limit]
+            next_cursor = pages[-1][cursor_field]
+
+        url_service = URLService()
+        return JsonResponse({
+            'pages': [self.get_page_data(page, url_service) for page in pages],
+            'next': next_cursor})
+
+    def get_int_param(self, name):
+        value = self.request.GET.get(name)
+        if not value:
+            return None
+        return int(value)
+
+    def get_page_data(self, page, url_service):
+        descendant_count = (page['rght'] - page['lft'] - 1) // 2
+        return {'pk': page['pk'],
+                'title': page['title'],
+                'slug': page['slug'],
+                'is_published': page['is_published'],
+                'is_deleted': page['is_deleted'],
+                'descendant_count': descendant_count,
+                'is_leaf': descendant_count == 0,
+                'edit_url': force_text(url_service.get_page_edit_url(page['pk']))}
 
 
 class DashboardPageCreateView(FormView):
@@ -99,9 +288,7 @@ class DashboardPageTemplateCreateView(FormView):
     form_class = forms.PageTemplateForm
 
     def form_valid(self, form):
-        PageService().create_page_template(
-            form.cleaned_data['name'],
-            form.cleaned_data['template_file'])
+        PageService().create_page_template(**form.cleaned_data)
         return HttpResponseRedirect(self.get_success_url())
 
     def get_success_url(self):
@@ -125,9 +312,7 @@ class DashboardPageTemplateEditView(FormView):
         return context
 
     def form_valid(self, form):
-        PageService().edit_page_template(self.object.pk,
-                                         form.cleaned_data['name'],
-                                         form.cleaned_data['template_file'])
+        PageService().edit_page_template(self.object.pk, **form.cleaned_data)
         return HttpResponseRedirect(self.get_success_url())
 
     def get_success_url(self):
@@ -154,12 +339,15 @@ class DashboardPageEditView(FormView):
         context['page'] = self.object
         context['page_template'] = page_template
         region_context = {}
+        region_blocks = service.get_content_blocks_info_for_page(self.object)
         for region in RegionService().get_regions_for_page(self.object):
-            content_blocks = service.get_content_blocks_info_for_region(
-                region, self.object)
-            region_context[region] = content_blocks
+            region_context[region] = region_blocks.get(region.pk, [])
         context['regions'] = region_context
         context['allowed_content_blocks'] = ContentBlockService().get_allowed_content_blocks()
+        snapshot_service = PageSnapshotService()
+        if snapshot_service.is_enabled():
+            context['snapshots_enabled'] = True
+            context['snapshots'] = snapshot_service.get_snapshots(self.object.pk)
         return context
 
     def form_valid(self, form):
@@ -170,6 +358,38 @@ class DashboardPageEditView(FormView):
         return URLService().get_page_index_url()
 
 
+class DashboardPageSnapshotView(View):
+    """ Base for views changing which snapshot of a page is live. They call
+        the snapshot service method named by snapshot_method with the URL
+        arguments named by snapshot_arguments, and are not found when
+        snapshots are off or the page does not exist.
+    """
+    snapshot_method = None
+    snapshot_arguments = ('pk',)
+
+    def post(self, request, *args, **kwargs):
+        service = PageSnapshotService()
+        if not service.is_enabled():
+            raise Http404
+        try:
+            getattr(service, self.snapshot_method)(
+                *[self.kwargs[name] for name in self.snapshot_arguments])
+        except ObjectDoesNotExist:
+            raise Http404
+        return HttpResponseRedirect(URLService().get_page_edit_url(int(self.kwargs['pk'])))
+
+
+class DashboardPagePublishView(DashboardPageSnapshotView):
+    """ Snapshots the current content of a page and makes it live """
+    snapshot_method = 'publish_page'
+
+
+class DashboardPageRollbackView(DashboardPageSnapshotView):
+    """ Makes an earlier snapshot of a page live again """
+    snapshot_method = 'rollback_page'
+    snapshot_arguments = ('pk', 'version')
+
+
 class DashboardTemplateRegionCreateView(FormView):
     template_name = 'dashboard/cms/region_create.html'
     form_class = forms.RegionForm
@@ -192,6 +412,30 @@ class DashboardTemplateRegionCreateView(FormView):
         return URLService().get_page_edit_url(int(self.kwargs['page']))
 
 
+class DashboardContentBlockReorderView(View):
+    """ Reorders the blocks of a region on a page. Takes the link pks of
+        the blocks along with the position each should move to.
+    """
+    def post(self, request, *args, **kwargs):
+        try:
+            positions = [int(position) for position in request.POST.getlist('position')]
+        except ValueError:
+            return HttpResponseBadRequest()
+        links = request.POST.getlist('link')
+        if len(positions) != len(links):
+            return HttpResponseBadRequest()
+
+        # Sorting is stable, so blocks given the same position keep their order
+        ordered_links = [link for position, link in sorted(
+            zip(positions, links), key=lambda item: item[0])]
+        try:
+            ContentBlockService().reorder_blocks(
+                self.kwargs['page'], self.kwargs['region'], ordered_links)
+        except (ObjectDoesNotExist, ValueError):
+            raise Http404
+        return HttpResponseRedirect(URLService().get_page_edit_url(int(self.kwargs['page'])))
+
+
 # The content block views are subclassed as they do a lot of boilerplate
 # things for the dynamic models and require a small amount of difference
 class DashboardContentBlockBaseView(TemplateView):
@@ -223,8 +467,11 @@ class DashboardContentBlockBaseView(TemplateView):
         return context
 
     def get_form_class_and_model(self):
-        contentblock_model = ContentBlockService().get_contentblock_model(
-            self.kwargs['content_type'])
+        try:
+            contentblock_model = ContentBlockService().get_contentblock_model(
+                self.kwargs['content_type'])
+        except LookupError:
+            raise Http404
         form_class = forms.get_modelform(contentblock_model)
         return form_class, contentblock_model
 
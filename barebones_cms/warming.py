@@ -0,0 +1,139 @@
+import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.db.models.loading import get_model
+from django.test.client import RequestFactory
+
+from barebones_cms.caching import page_hits
+from barebones_cms.rendering import call_with_connection
+from barebones_cms.views import ServeCMSPageView
+
+
+# Allow the cms app to be completely overridden with another namespace
+CMS_APP = getattr(settings, 'BB_CMS_APP_NAME', 'apps.cms').split('.')[-1]
+
+WARMED = 'warmed'
+CACHED = 'cached'
+FAILED = 'failed'
+
+
+logger = logging.getLogger('barebones_cms')
+Page = get_model(CMS_APP, 'Page')
+
+
+class TokenBucket(object):
+    """ Lets callers through at an average rate per second, with bursts of
+        up to burst at once. Thread safe.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Blocks until a token is available and takes it """
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class WarmingProgress(object):
+    def __init__(self, total):
+        self.total = total
+        self.started = time.time()
+        self.counts = {WARMED: 0, CACHED: 0, FAILED: 0}
+
+    @property
+    def done(self):
+        return sum(self.counts.values())
+
+    def get_elapsed(self):
+        return time.time() - self.started
+
+    def get_rate(self):
+        elapsed = self.get_elapsed()
+        return self.done / elapsed if elapsed else 0.0
+
+
+class PageCacheWarmer(object):
+    """ Renders published pages into the page cache, most popular first.
+
+        Pages are requested through the serving view on a small thread pool,
+        so they are rendered and stored exactly as a visitor's request would.
+        Pages that are already cached and fresh are left alone. A token
+        bucket caps the pages rendered per second so warming leaves room for
+        live traffic.
+    """
+    view_class = ServeCMSPageView
+
+    def __init__(self, workers=2, rate=None):
+        self.workers = workers
+        self.limiter = TokenBucket(rate, burst=workers) if rate else None
+
+    def get_paths(self, limit=None):
+        """ Returns the paths of published pages ordered by their recorded
+            hits, then by their place in the page tree
+        """
+        paths = list(Page.objects.exclude(path=None).order_by(
+            'tree_id', 'lft').values_list('path', flat=True))
+        counts = page_hits.get_counts(paths)
+        # The sort is stable, so pages without hits stay in tree order
+        paths.sort(key=lambda path: -counts.get(path, 0))
+        return paths[:limit] if limit else paths
+
+    def warm(self, paths, progress_callback=None):
+        """ Warms every path and returns a WarmingProgress with the outcome
+            counts. The callback is called with the progress after each page.
+        """
+        progress = WarmingProgress(len(paths))
+        pool = ThreadPool(self.workers)
+        try:
+            for outcome in pool.imap_unordered(self.warm_path_in_thread, paths):
+                progress.counts[outcome] += 1
+                if progress_callback is not None:
+                    progress_callback(progress)
+        finally:
+            pool.terminate()
+            pool.join()
+        return progress
+
+    def warm_path_in_thread(self, path):
+        if self.limiter is not None:
+            self.limiter.acquire()
+        return call_with_connection(self.warm_path, path)
+
+    def warm_path(self, path):
+        try:
+            response = self.get_response(path)
+            if response.status_code != 200:
+                return FAILED
+            if response.streaming:
+                # Streamed pages are stored once the last chunk has been read
+                b''.join(response.streaming_content)
+        except Exception:
+            # One broken page should not stop the rest being warmed
+            logger.exception("Could not warm the cache for /%s/", path)
+            return FAILED
+        if response.get('X-CMS-Cache') in ('HIT', 'STALE'):
+            return CACHED
+        return WARMED
+
+    def get_response(self, path):
+        request = RequestFactory().get('/%s/' % path)
+        # Cached pages are shared by every visitor, as anonymous ones see them
+        request.user = AnonymousUser()
+        return self.view_class.as_view(record_hits=False)(request)
@@ -10,3 +10,4 @@ admin.site.register(models.Region)  # pragma: no cover
 admin.site.register(SimpleContentBlock)  # pragma: no cover
 admin.site.register(models.ContentBlockLink)  # pragma: no cover
 
+admin.site.register(models.PageSnapshot)  # pragma: no cover
@@ -1,6 +1,7 @@
 from django.db import models
 
 from barebones_cms import models as bb_models
+from barebones_cms.registry import content_block_registry
 
 
 class Page(bb_models.BasePage):
@@ -18,3 +19,11 @@ class ContentBlockLink(bb_models.BaseContentBlockLink):
 class Region(bb_models.BaseRegion):
     pass
 
+
+class PageSnapshot(bb_models.BasePageSnapshot):
+    pass
+
+
+# The simple content block lives in the barebones_cms app
+content_block_registry.register(bb_models.SimpleContentBlock)
+